@@ -0,0 +1,151 @@
+"""Dense yearly totals over categorical dimensions, with rolling means.
+
+The fire perimeters are summed once into a dense array with one axis per
+dimension (e.g. cause, size class) and a last axis of calendar years. Each
+dimension axis has one extra entry, its total ("All"), so any selection is
+an index into the array rather than a groupby. Cumulative sums along the
+years serve a moving average over any window in O(years).
+
+Years without records count as zero, so a window spans calendar years
+rather than rows of records.
+
+Example:
+
+    cube = aggregates.YearlyCube(fire_df.YEAR, fire_df.GIS_ACRES,
+                                 cause=fire_df.CAUSE,
+                                 size=aggregates.size_class(fire_df.GIS_ACRES))
+    cube.rolling_mean(15, cause=1)
+    cube.frame(15, size='G')
+
+"""
+
+import numpy as np
+import pandas as pd
+
+ALL = 'All'
+
+# NWCG fire size classes, by lower bound in acres
+SIZE_CLASSES = {'A': 0, 'B': .25, 'C': 10, 'D': 100, 'E': 300, 'F': 1000,
+                'G': 5000}
+
+def size_class(acres):
+    """The NWCG size class (A-G) of each area in acres; NaN is 'A'."""
+    labels = np.array(list(SIZE_CLASSES))
+    bounds = list(SIZE_CLASSES.values())[1:]
+    return labels[np.searchsorted(bounds, np.nan_to_num(acres), 'right')]
+
+class YearlyCube(object):
+    """Yearly sums of a value over every combination of categories.
+
+    Attributes:
+        years: Array of the calendar years, consecutive
+        dims: List of dimension names, in axis order
+        labels: Dict of {dimension: array of its categories}; index
+            len(labels[dim]) on that axis is the total over the dimension
+        totals: Array (len(labels[d]) + 1 for d in dims..., years) of sums
+
+    External methods:
+        series: Yearly sums for a selection.
+        rolling_mean: Trailing moving average of the yearly sums.
+        frame: Yearly sums and moving average as a dataframe, for charts.
+    """
+    def __init__(self, years, values, **dims):
+        """
+        Arguments:
+            years: Year of each record, integers
+            values: Value of each record; NaN counts as zero
+            dims: Category of each record in each named dimension, as
+                arrays of the records' length
+        """
+        years = np.asarray(years, dtype=int)
+        values = np.nan_to_num(np.asarray(values, dtype=float))
+        self.years = np.arange(years.min(), years.max() + 1)
+        self.dims = list(dims)
+        self.labels = {}
+        codes = []
+        for name, categories in dims.items():
+            self.labels[name], code = np.unique(categories,
+                                                return_inverse=True)
+            codes.append(code.ravel())
+        codes.append(years - self.years[0])
+        shape = tuple(len(self.labels[d]) for d in self.dims) + (
+            len(self.years),)
+        flat = np.bincount(np.ravel_multi_index(codes, shape),
+                           weights=values, minlength=int(np.prod(shape)))
+
+        # pad each dimension with its total, so "All" is an index too
+        totals = flat.reshape(shape)
+        for axis in range(len(self.dims)):
+            totals = np.concatenate(
+                [totals, totals.sum(axis=axis, keepdims=True)], axis=axis)
+        self.totals = totals
+        self._cumsum = np.concatenate(
+            [np.zeros(totals.shape[:-1] + (1,)), np.cumsum(totals, axis=-1)],
+            axis=-1)
+
+    def _index(self, selection):
+        """Index into totals of a selection of {dimension: category}."""
+        unknown = set(selection) - set(self.dims)
+        if unknown:
+            raise ValueError('Unknown dimensions: %s' % sorted(unknown))
+        index = []
+        for name in self.dims:
+            labels = self.labels[name]
+            category = selection.get(name, ALL)
+            if isinstance(category, str) and category == ALL:
+                index.append(len(labels))
+                continue
+            k = np.searchsorted(labels, category)
+            if k == len(labels) or labels[k] != category:
+                # a category without records sums to zero
+                return None
+            index.append(k)
+        return tuple(index)
+
+    def series(self, **selection):
+        """Yearly sums for a selection, e.g. cause=1; omitted dimensions
+        are summed over (ALL).
+
+        Returns: An array over years.
+        """
+        index = self._index(selection)
+        if index is None:
+            return np.zeros(len(self.years))
+        return self.totals[index]
+
+    def rolling_mean(self, window, **selection):
+        """Trailing moving average of the yearly sums.
+
+        Each year is averaged with the window years before it, like
+        Vega-Lite's frame [-window, 0]; the first years average over those
+        available.
+
+        Returns: An array over years.
+        """
+        index = self._index(selection)
+        if index is None:
+            return np.zeros(len(self.years))
+        cumsum = self._cumsum[index]
+        hi = np.arange(1, len(self.years) + 1)
+        lo = np.maximum(hi - window - 1, 0)
+        return (cumsum[hi] - cumsum[lo]) / (hi - lo)
+
+    def frame(self, window, start=None, **selection):
+        """Yearly sums and their moving average, as a dataframe.
+
+        Arguments:
+            window: Number of preceding years in the moving average
+            start: First year to include; the moving average still uses
+                the years before it.
+            selection: {dimension: category}, cf. series
+
+        Returns: A dataframe with columns year (datetime), total and
+            rolling_mean.
+        """
+        keep = slice(None if start is None else
+                     max(int(start) - self.years[0], 0), None)
+        return pd.DataFrame({
+            'year': pd.to_datetime(self.years[keep].astype(str),
+                                   format='%Y'),
+            'total': self.series(**selection)[keep],
+            'rolling_mean': self.rolling_mean(window, **selection)[keep]})
@@ -2,11 +2,16 @@ import pandas as pd
 import numpy as np
 import altair as alt
 import streamlit as st
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import datetime
+import os
+import aggregates
+import datastore
+import decimate
+import discontinuity
+import raster
+import threading
+import time
 import model
-from PIL import Image
+import scenario_grid
 
 st.header("Earthrise Report \\#1")
 
@@ -80,21 +85,15 @@ trends.
 # firedf['YEAR'] = gpd.pd.to_numeric(firedf.YEAR_)
 # firedf[["YEAR", 'GIS_ACRES', "CAUSE"]].to_pickle("data/firedata.pkl")
 
-@st.cache
 def load_data(plot=True):
-	bidf = pd.read_pickle("data/nfdrs.pkl")
-	firedf = pd.read_pickle("data/firedata.pkl")
+	# memory-mapped columns, converted once from the pickles by datastore
+	bidf = datastore.load('nfdrs')
+	firedf = datastore.load('fire')
 
 	return firedf, bidf
 
 fire_df, nfdrs_df = load_data()
 
-def convert_time(x):
-	utc_time = datetime.datetime.strptime(x, "%Y-%m-%d")
-	epoch_time = (utc_time - datetime.datetime(1970, 1, 1)).total_seconds()
-	return epoch_time * 1000
-
-
 nfdrs_label = st.selectbox(
 	'Variable',
 	['fuel moisture (percent)', 'burn index (0-100)']
@@ -111,29 +110,39 @@ nfdrs_var = vardict[nfdrs_label]
 
 vis = {'fm100': [0, 30], 'bi': [0, 80]}
 
-t0 = convert_time(nfdrs_df.date.iloc[0])
-t1 = convert_time(nfdrs_df.date.iloc[-1])
-break_t = convert_time('%s-01-01' % break_point)
+@st.cache_resource
+def discontinuity_engine(var):
+	# Prefix sums over the series, so that any break is fit in O(1)
+	engine = discontinuity.BreakRegression(
+		nfdrs_df.date.values, nfdrs_df[var].values)
+	return engine, engine.best_break()
+
+engine, best = discontinuity_engine(nfdrs_var)
+
+# Points sent to the browser: two to four per pixel column of the chart,
+# however long the series; narrow screens may ask for fewer with
+# ?width=<pixels>, clamped to [1, CHART_WIDTH]; anything else is ignored.
+CHART_WIDTH = 700
+try:
+	chart_width = int(st.experimental_get_query_params().get(
+		'width', [CHART_WIDTH])[0])
+except ValueError:
+	chart_width = CHART_WIDTH
+chart_width = min(max(chart_width, 1), CHART_WIDTH)
 
-df1 = nfdrs_df[nfdrs_df.date < '%s-01-01' % break_point]
-df2 = nfdrs_df[nfdrs_df.date >= '%s-01-01' % break_point]
+@st.cache_resource
+def nfdrs_levels(var):
+	return decimate.Pyramid(nfdrs_df.date.values, nfdrs_df[var].values)
+
+nfdrs_points = nfdrs_df[['date', nfdrs_var]].iloc[
+	nfdrs_levels(nfdrs_var).select(2 * chart_width)]
+
+break_date = np.datetime64('%s-01-01' % break_point)
+rd = engine.test([break_date]).iloc[0]
 
  
 # Fire index
-nfdrs_data_1 = alt.Chart(df1).mark_circle(
-	color="#A9BEBE", 
-	size=1.5
-).encode(
-	x=alt.X(
-		'date:T',
-		axis=alt.Axis(
-			title=""
-		)
-	),
-	y=alt.Y(nfdrs_var, axis=alt.Axis(title=""))
-)
-
-nfdrs_data_2 = alt.Chart(df2).mark_circle(
+nfdrs_data = alt.Chart(nfdrs_points).mark_circle(
 	color="#A9BEBE", 
 	size=1.5
 ).encode(
@@ -146,28 +155,34 @@ nfdrs_data_2 = alt.Chart(df2).mark_circle(
 	y=alt.Y(nfdrs_var, axis=alt.Axis(title=""))
 )
 
-
-line_1 = nfdrs_data_1.transform_regression(
-	'date', 
-	nfdrs_var,
-	extent=[t0, break_t]
-).mark_line(
-	color='#e45756'
-)
-
-line_2 = nfdrs_data_2.transform_regression(
-	'date', 
-	nfdrs_var,
-	extent=[break_t, t1]
-).mark_line(
+# The two fitted lines, as four endpoints computed here
+lines = alt.Chart(engine.segments(break_date)).mark_line(
 	color='#e45756'
+).encode(
+	x='t:T',
+	y='y:Q',
+	detail='side:N'
 )
 
 st.altair_chart(
-	nfdrs_data_1 + nfdrs_data_2 + line_1 + line_2,
+	nfdrs_data + lines,
 	use_container_width=True
 )
 
+best_break = pd.Timestamp(best['break']).strftime('%Y-%m-%d')
+if np.isnan(rd.jump):
+	st.markdown("""
+Too few days on one side of %s to fit a trend.  The break that best
+separates two trends is **%s**.
+""" % (break_point, best_break))
+else:
+	st.markdown("""
+Trend before %s: **%+.3f** per year (s.e. %.3f); after: **%+.3f** per year
+(s.e. %.3f).  Jump at the break: **%+.2f** (p = %.3g; Chow test p = %.3g).
+The break that best separates two trends is **%s**.
+""" % (break_point, rd.slope_left, rd.slope_se_left, rd.slope_right,
+		rd.slope_se_right, rd.jump, rd.jump_p, rd.chow_p, best_break))
+
 st.markdown(""" 
 
 > *There is a statistically significant time trend for both variables.* 
@@ -228,21 +243,19 @@ cause_option = st.selectbox(
 )
 
 
-if cause_option != 'All':
-	fire_df = fire_df[fire_df.CAUSE == cause_dict[cause_option]]
+@st.cache_resource
+def burned_area_cube():
+	# Yearly acres for every cause and for all causes, summed once
+	recent = fire_df[fire_df.YEAR > 1910]
+	return aggregates.YearlyCube(
+		recent.YEAR, recent.GIS_ACRES, cause=recent.CAUSE)
 
-tot = fire_df.groupby('YEAR')['GIS_ACRES'].sum()
-tot = gpd.pd.DataFrame(tot).reset_index()
-tot.columns = ["year", "acres"]
-tot = tot[tot.year > 1910]
-tot.year = pd.to_datetime(tot.year, format='%Y')
+tot = burned_area_cube().frame(
+	window, cause=cause_dict.get(cause_option, aggregates.ALL))
 
 
-line_smooth = alt.Chart(tot).mark_line(
+line_smooth = alt.Chart(tot[['year', 'rolling_mean']]).mark_line(
 	color='#e45756'
-).transform_window(
-	rolling_mean='mean(acres)',
-	frame=[-window, 0]
 ).encode(
 	x=alt.X('year:T', axis=alt.Axis(title="")),
 	y=alt.Y('rolling_mean:Q', axis=alt.Axis(title="Burned area (acres)"))
@@ -352,20 +365,77 @@ contact_matrices, epoch_end_times = model.model_input(
 	selected_npis,
     END_DAY-START_DAY)
 
-res = model.SEIRModel(contact_matrices, epoch_end_times)
-
-df, y = res.solve_to_dataframe(pop_0.flatten(), detailed_output=True)
-infected = df[df["Group"] == "Infected"]
-
-chart = alt.Chart(infected).mark_line(
-	color="#e45756").encode(
-		x=alt.X('days', axis=alt.Axis(title='Days')),
-		y=alt.Y('pop', axis=alt.Axis(title=''),
-                scale=alt.Scale(domain=(0,TOTAL_POPULATION/10))))
+@st.cache_resource
+def solver_state():
+    # One model kept across reruns, so that a slider change only
+    # re-integrates from the last epoch checkpoint before it takes effect.
+    return {'model': None, 'lock': threading.Lock()}
+
+# hidden solver profile, shown when the page is opened with ?debug=1
+debug = 'debug' in st.experimental_get_query_params()
+
+@st.cache_resource
+def precomputed_grid():
+    # Built by the Docker build, cf. scenario_grid.py; absent, every change
+    # is solved.
+    path = 'data/scenario_grid'
+    return scenario_grid.ScenarioGrid(path) if os.path.exists(path) else None
+
+def infection_chart(infected):
+    return alt.Chart(infected).mark_line(
+        color="#e45756").encode(
+            x=alt.X('days', axis=alt.Axis(title='Days')),
+            y=alt.Y('pop', axis=alt.Axis(title=''),
+                    scale=alt.Scale(domain=(0,TOTAL_POPULATION/10))))
 
 st.markdown('Infections (per million)' )
 
-st.altair_chart(chart, use_container_width=True)
+chart_slot = st.empty()
+
+# draw the grid lookup at once; a schedule off the grid, at day resolution,
+# gets it only as a preview, replaced below by the live solve
+grid = precomputed_grid()
+tick = time.perf_counter()
+preview = grid.lookup(npi_intervals) if grid is not None else None
+on_grid = preview is not None and grid.on_grid(npi_intervals)
+lookup_ms = 1000 * (time.perf_counter() - tick)
+if preview is not None:
+    chart_slot.altair_chart(infection_chart(pd.DataFrame(
+        {'days': np.arange(len(preview)), 'Group': 'Infected',
+         'pop': preview[:,0]})), use_container_width=True)
+elif grid is not None:
+    grid.fill_async(npi_intervals)
+
+# with ?debug=1 a grid hit is solved live as well, so there is a profile
+profile = None
+if debug or not on_grid:
+    state = solver_state()
+    with state['lock']:
+        if state['model'] is None:
+            state['model'] = model.SEIRModel(
+                contact_matrices, epoch_end_times)
+        else:
+            state['model'].reschedule(contact_matrices, epoch_end_times)
+        res = state['model']
+        profile = res.instrument(debug)
+        # piecewise, so epoch checkpoints are kept for the next re-solve;
+        # RK45 is still faster here than the fixed-step RK4
+        solution = res.solve_to_dataframe(
+            pop_0.flatten(), columnar=True, piecewise=True,
+            cache=model.SOLUTION_CACHE)
+    chart_slot.altair_chart(infection_chart(solution.to_frame(['Infected'])),
+                            use_container_width=True)
+
+if debug:
+    with st.expander('Solver profile'):
+        st.json({'grid': 'absent' if grid is None else
+                 'hit' if on_grid else
+                 'miss' if preview is None else 'preview',
+                 'grid_lookup_ms': lookup_ms,
+                 'solution_cache': model.SOLUTION_CACHE.stats()})
+        report = profile.report()
+        st.json({k: v for k, v in report.items() if k != 'epochs'})
+        st.dataframe(profile.epochs_frame())
 
 
 st.write("""
@@ -412,9 +482,13 @@ the soil at a depth of 0-30cm.
 
 """)
 
-image = np.array(Image.open('data/nitrogen.tif')).astype('float')
-vals = np.array(image).ravel()
-minimage, maximage = [int(min(vals)), int(max(vals))]
+@st.cache_resource
+def nitrogen_raster():
+	# Tiles, overviews and statistics, converted once, cf. raster.py
+	return raster.load('nitrogen')
+
+nitrogen = nitrogen_raster()
+minimage, maximage = int(nitrogen.min), int(nitrogen.max)
 
 delta = int(maximage - minimage)
 
@@ -423,15 +497,11 @@ viz_window = st.slider(
 	minimage, maximage, (int(0.2 * delta) + 4, int(0.8 * delta))
 )
 
-minval, maxval = viz_window
-image[(image < minval) | (image > maxval)] = np.nan
-
-fig, ax = plt.subplots(1, 1)
-ax.matshow(image, cmap="twilight_shifted")
-ax.axis('off')
-ax.axes.yaxis.set_visible(False)
-
-st.pyplot()
+# Only the overview level that fills the page is read and colored
+st.image(
+	nitrogen.render(viz_window, width=CHART_WIDTH),
+	use_column_width=True
+)
 
 st.subheader("Policy")
 
@@ -0,0 +1,174 @@
+"""Headless batch runner: scenario requests in, model results out, as JSONL.
+
+Each input line is a JSON object such as
+
+    {"id": "eu-schools", "region": "Europe", "total_days": 300,
+     "interventions": [{"npi": "School closure", "start": 30, "end": 70}],
+     "initial_infected": 0.001, "population": 1e6,
+     "parameters": {"prob_of_transmission": 0.03}, "daily": false}
+
+where only region is required; parameters are SEIRModel keyword
+arguments. Each output line carries the id (the line number by default),
+the outcomes of SEIRModel.solve_summary and, with "daily": true, the daily
+totals of every compartment; a request that fails yields its id and an
+error message instead.
+
+Lines are read lazily and solved in chunks across a process pool with a
+bounded number of chunks in flight, and results are written in input order
+as they complete, so memory stays flat however long the input:
+
+    python batch.py scenarios.jsonl --output results.jsonl
+    python batch.py - --output results.parquet < scenarios.jsonl
+
+Parquet output requires pyarrow; each chunk becomes a row group.
+
+"""
+
+import argparse
+import itertools
+import json
+import sys
+
+import numpy as np
+
+import model
+import uncertainty
+
+def run_request(request):
+    """Solve one scenario request.
+
+    Arguments:
+        request: Dict as described in the module docstring
+
+    Returns: A dict of results, cf. the module docstring.
+    """
+    region = request['region']
+    if region not in model.WORLD_POP:
+        raise ValueError('Unknown region: %s' % region)
+    interventions = request.get('interventions', [])
+    contacts, epoch_end_times = model.model_input(
+        model.CONTACT_MATRICES_0[region],
+        [(i['start'], i['end']) for i in interventions],
+        [i['npi'] for i in interventions],
+        request.get('total_days', 300))
+    seir = model.SEIRModel(contacts, epoch_end_times,
+                           **request.get('parameters', {}))
+    y0 = uncertainty.initial_state(
+        region, request.get('initial_infected', .001),
+        request.get('population', 1e6)).flatten()
+
+    result = {'id': request.get('id')}
+    result.update(seir.solve_summary(y0, piecewise=True)._asdict())
+    if request.get('daily', False):
+        t, y = seir.solve(y0, piecewise=True)
+        totals = y.reshape(seir.N_cohorts, seir.N_compartments, len(t)).sum(
+            axis=0)
+        result['daily'] = dict(zip(seir.compartments, totals.tolist()))
+    return result
+
+def run(lines, chunk_size=64, processes=None):
+    """Solve scenario requests, yielding result dicts in input order.
+
+    Arguments:
+        lines: Iterable of JSONL lines; blank lines are skipped but counted
+        chunk_size: Number of requests per task sent to a worker
+        processes: Number of worker processes; defaults to the CPU count
+    """
+    numbered = ((n, line) for n, line in enumerate(lines, 1) if line.strip())
+    chunks = ((chunk,) for chunk in _chunked(numbered, chunk_size))
+    for results in uncertainty.map_ordered(_run_chunk, chunks, processes):
+        for result in results:
+            yield result
+
+def _chunked(iterable, size):
+    """Yield lists of up to size items, reading iterable lazily."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _run_chunk(chunk):
+    results = []
+    for n, line in chunk:
+        request = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('A request must be a JSON object.')
+            request.setdefault('id', n)
+            results.append(run_request(request))
+        except Exception as e:
+            results.append({
+                'id': request.get('id', n) if isinstance(request, dict)
+                else n,
+                'error': '%s: %s' % (type(e).__name__, e)})
+    return results
+
+def _default(value):
+    """JSON encoding of the numpy scalars in results."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(repr(value))
+
+def write_jsonl(results, f):
+    """Write result dicts as JSON lines."""
+    for result in results:
+        f.write(json.dumps(result, default=_default) + '\n')
+
+def _parquet_schema():
+    """Schema of the Parquet output, fixed so that every chunk agrees."""
+    import pyarrow as pa
+    daily = pa.struct([(c, pa.list_(pa.float64()))
+                       for c in model.COMPARTMENTS])
+    return pa.schema(
+        [('id', pa.string())] +
+        [(field, pa.float64()) for field in model.Summary._fields] +
+        [('daily', daily), ('error', pa.string())])
+
+def _parquet_row(result):
+    """A result dict as a row of _parquet_schema."""
+    row = {'id': None if result.get('id') is None else str(result['id']),
+           'daily': result.get('daily'), 'error': result.get('error')}
+    for field in model.Summary._fields:
+        value = result.get(field)
+        row[field] = None if value is None else float(value)
+    return row
+
+def write_parquet(results, path, chunk_size=64):
+    """Write result dicts to a Parquet file, one row group per chunk.
+
+    Ids are written as strings, and rows without daily totals or without
+    an error have nulls there.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = _parquet_schema()
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in _chunked(results, chunk_size):
+            writer.write_table(pa.Table.from_pylist(
+                [_parquet_row(row) for row in rows], schema=schema))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Solve SEIR scenario requests from JSONL.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help="JSONL file of requests, or '-' for stdin")
+    parser.add_argument('--output', default='-',
+                        help="Output file, or '-' for stdout; a .parquet "
+                             "suffix selects Parquet.")
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == '-' else open(args.input)
+    with source:
+        results = run(source, args.chunk_size, args.processes)
+        if args.output.endswith('.parquet'):
+            write_parquet(results, args.output, args.chunk_size)
+        elif args.output == '-':
+            write_jsonl(results, sys.stdout)
+        else:
+            with open(args.output, 'w') as f:
+                write_jsonl(results, f)
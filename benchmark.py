@@ -0,0 +1,398 @@
+"""Benchmarks for the SEIR model solvers and the app data paths.
+
+Run as a script to print timing tables, optionally saving them as JSON and
+comparing against a saved baseline:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 1.25
+
+The comparison exits with status 1 if any timing grew by more than the
+tolerance factor.
+
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from PIL import Image
+
+import aggregates
+import datastore
+import model
+import raster
+
+METHODS = ['RK45', 'RK23', 'LSODA', 'BDF', 'Radau']
+
+# Rate regimes: the default disease parameters, and a stiff variant with
+# incubation and time to death short compared with the daily output grid.
+REGIMES = {
+    'default': {},
+    'stiff': {'incubation_period': 0.05, 'time_to_death': 0.1}
+}
+
+def _scenario(total_days, region='Americas', initial_infected=.001,
+              population=1e6):
+    """Return contact matrices, epoch end times and y0 like those in app.py."""
+    intervals = [(30, 70), (30, 80), (30, 100), (70, 200), (20, 20)]
+    npis = ['School closure', 'Cancel mass gatherings',
+            'Shielding the elderly', 'Quarantine and tracing',
+            'Shelter in place']
+    contacts, epoch_end_times = model.model_input(
+        model.CONTACT_MATRICES_0[region], intervals, npis, total_days)
+    pop = population * model.WORLD_POP[region]
+    y0 = np.array([[f * (1 - 2 * initial_infected), f * initial_infected,
+                    f * initial_infected, 0, 0, 0] for f in pop])
+    return contacts, epoch_end_times, y0.flatten()
+
+def _time(fn, repeat=3):
+    """Return the best wall time of several calls to fn, in seconds."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_methods(horizons=(300, 1000, 3650), regimes=REGIMES,
+                  methods=METHODS + model.FIXED_STEP_METHODS, piecewise=True,
+                  repeat=3):
+    """Time each solver method across horizons and rate regimes.
+
+    Returns: A dataframe with one row per (regime, horizon, method), giving
+        the best wall time in milliseconds and the solver statistics.
+    """
+    rows = []
+    for regime, params in regimes.items():
+        for horizon in horizons:
+            contacts, epoch_end_times, y0 = _scenario(horizon)
+            for method in methods:
+                # a fresh model each time, so no checkpoints are reused
+                def solve():
+                    seir = model.SEIRModel(contacts, epoch_end_times, **params)
+                    return seir._solve(y0, piecewise, method=method)
+                _, _, stats = solve()
+                ms = 1000 * _time(solve, repeat)
+                rows.append(dict(regime=regime, horizon=horizon,
+                                 method=method, ms=ms, **stats))
+    return pd.DataFrame(rows)
+
+def bench_model_input(sizes=(10, 100, 1000, 10000), total_days=3650,
+                      repeat=3, seed=0):
+    """Time model_input as the number of interventions grows.
+
+    Interventions are drawn at random, with daily resolution, over
+    total_days from the NPIs in model.NPI_IMPACTS.
+
+    Returns: A dataframe with the best wall time in milliseconds and the
+        number of epochs before and after merging equal neighbours.
+    """
+    rng = np.random.default_rng(seed)
+    npis = list(model.NPI_IMPACTS)
+    rows = []
+    for size in sizes:
+        starts = rng.integers(0, total_days, size)
+        day_ranges = [(int(s), int(s + d)) for s, d in
+                      zip(starts, rng.integers(1, 90, size))]
+        selected_npis = list(rng.choice(npis, size))
+        args = (model.CONTACT_MATRICES_0['Americas'], day_ranges,
+                selected_npis, total_days)
+        ms = 1000 * _time(lambda: model.model_input(*args), repeat)
+        rows.append(dict(
+            interventions=size, ms=ms,
+            epochs=len(model.model_input(*args, merge=False)[1]),
+            merged_epochs=len(model.model_input(*args)[1])))
+    return pd.DataFrame(rows)
+
+def rk4_error(regimes=REGIMES, regions=model.WORLD_POP, horizon=300,
+              population=1e6, step_rate=model.RK4_STEP_RATE):
+    """Report the error of the fixed-step RK4 backend.
+
+    The reference is a piecewise DOP853 solve at rtol=1e-11; the bound at
+    the default step rate is tested in test_model.py.
+
+    Returns: A dataframe of the largest deviation on any day, in any
+        compartment, as a fraction of the population, by regime and region.
+    """
+    rows = []
+    for regime, params in regimes.items():
+        for region in regions:
+            contacts, epoch_end_times, y0 = _scenario(
+                horizon, region, population=population)
+            seir = model.SEIRModel(contacts, epoch_end_times, **params)
+            _, reference = seir.solve(
+                y0, piecewise=True, method='DOP853', rtol=1e-11, atol=1e-8)
+            _, y = seir.solve(y0, method='RK4', step_rate=step_rate)
+            error = np.abs(y - reference).max() / population
+            rows.append(dict(regime=regime, region=region, error=error))
+    return pd.DataFrame(rows)
+
+def bench_metapopulation(sizes=(100, 1000, 4000), links=5, total_days=300,
+                         repeat=1, seed=0):
+    """Time SEIRMetapopulation as the number of regions grows.
+
+    Regions draw their base contact matrix from model.CONTACT_MATRICES_0 and
+    a month of shelter in place at a random start; each region sends 1% of
+    its contacts along each of links random mobility links. The outbreak
+    seeds a single region.
+
+    Returns: A dataframe with the best wall time in milliseconds and the
+        number of segments in the merged schedule.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for size in sizes:
+        regions = rng.choice(list(model.WORLD_POP), size)
+        contacts, epoch_end_times = [], []
+        for region, start in zip(regions, rng.integers(10, 100, size)):
+            c, ends = model.model_input(
+                model.CONTACT_MATRICES_0[region], [(start, start + 30)],
+                ['Shelter in place'], total_days)
+            contacts.append(c)
+            epoch_end_times.append(ends)
+        mobility = scipy.sparse.csr_matrix(
+            (np.full(size * links, .01),
+             (np.repeat(np.arange(size), links),
+              rng.integers(0, size, size * links))), shape=(size, size))
+        y0 = np.zeros((size, len(model.AGE_COHORTS),
+                       len(model.COMPARTMENTS)))
+        for n, region in enumerate(regions):
+            y0[n,:,0] = 1e5 * model.WORLD_POP[region]
+        y0[0,:,2] = y0[0,:,0] * .001
+
+        def solve():
+            meta = model.SEIRMetapopulation(
+                contacts, epoch_end_times, mobility)
+            return meta.solve(y0)
+        ms = 1000 * _time(solve, repeat)
+        segments = len(model.SEIRMetapopulation(
+            contacts, epoch_end_times, mobility).segment_end_times)
+        rows.append(dict(regions=size, links=mobility.nnz, ms=ms,
+                         segments=segments))
+    return pd.DataFrame(rows)
+
+def _synthetic(n_cohorts, n_epochs, horizon, seed=0):
+    """Return a random model schedule and y0 with any number of cohorts.
+
+    Contact matrices are symmetric with the mean row sum of the Americas
+    matrix, scaled by a random factor per epoch; the epochs are evenly
+    spaced over the horizon.
+    """
+    rng = np.random.default_rng(seed)
+    base = rng.random((n_cohorts, n_cohorts))
+    base = base + base.T
+    base *= model.CONTACT_MATRICES_0['Americas'].sum(axis=1).mean() / (
+        base.sum(axis=1).mean())
+    contacts = [base * f for f in rng.uniform(.3, 1, n_epochs)]
+    epoch_end_times = list(np.linspace(0, horizon, n_epochs + 1)[1:])
+    pop = 1e6 * rng.dirichlet(np.ones(n_cohorts))
+    y0 = np.zeros((n_cohorts, len(model.COMPARTMENTS)))
+    y0[:,0], y0[:,1], y0[:,2] = pop * .998, pop * .001, pop * .001
+    return contacts, epoch_end_times, y0.flatten()
+
+def bench_rhs(cohorts=(3, 10, 30), number=1000, repeat=5):
+    """Time single calls of SEIRModel.f.
+
+    Returns: A dataframe with the best time per call in microseconds.
+    """
+    rows = []
+    for n in cohorts:
+        contacts, epoch_end_times, y0 = _synthetic(n, 10, 300)
+        seir = model.SEIRModel(contacts, epoch_end_times,
+                               mortality_rates=np.full(n, .01), N_cohorts=n)
+        def calls():
+            for t in np.linspace(0, 300, number):
+                seir.f(t, y0)
+        us = 1e6 * _time(calls, repeat) / number
+        rows.append(dict(cohorts=n, us=us))
+    return pd.DataFrame(rows)
+
+def bench_solve(cohorts=(3, 10, 30), horizons=(300, 1000, 3650),
+                epochs=(1, 10, 100), repeat=3, **options):
+    """Time solve and solve_to_dataframe across model sizes and schedules.
+
+    Each timed call builds a fresh model, so no checkpoints are reused.
+
+    Returns: A dataframe with the best wall time of each, in milliseconds.
+    """
+    rows = []
+    for n in cohorts:
+        for horizon in horizons:
+            for n_epochs in epochs:
+                contacts, epoch_end_times, y0 = _synthetic(
+                    n, n_epochs, horizon)
+                def fresh():
+                    return model.SEIRModel(
+                        contacts, epoch_end_times,
+                        mortality_rates=np.full(n, .01), N_cohorts=n)
+                solve_ms = 1000 * _time(
+                    lambda: fresh().solve(y0, **options), repeat)
+                dataframe_ms = 1000 * _time(
+                    lambda: fresh().solve_to_dataframe(y0, **options), repeat)
+                rows.append(dict(cohorts=n, horizon=horizon, epochs=n_epochs,
+                                 solve_ms=solve_ms, dataframe_ms=dataframe_ms))
+    return pd.DataFrame(rows)
+
+def bench_app_data(repeat=5, data='data'):
+    """Time the data paths of app.py outside the model.
+
+    Covers loading the two pickles and their columnar copies, the yearly
+    burned-area aggregation, by groupby and from the precomputed cube, and
+    the statistics and masking of the nitrogen raster, from the GeoTIFF and
+    from its tiled copy.
+
+    Returns: A dataframe with the best wall time of each step in
+        milliseconds.
+    """
+    def load():
+        return (pd.read_pickle('%s/firedata.pkl' % data),
+                pd.read_pickle('%s/nfdrs.pkl' % data))
+    fire_df, _ = load()
+
+    def aggregate():
+        tot = fire_df.groupby('YEAR')['GIS_ACRES'].sum()
+        tot = pd.DataFrame(tot).reset_index()
+        tot.columns = ['year', 'acres']
+        tot = tot[tot.year > 1910]
+        tot.year = pd.to_datetime(tot.year, format='%Y')
+        return tot
+
+    recent = fire_df[fire_df.YEAR > 1910]
+    cube = aggregates.YearlyCube(recent.YEAR, recent.GIS_ACRES,
+                                 cause=recent.CAUSE)
+
+    def from_cube():
+        return cube.frame(15, cause=1)
+
+    def nitrogen_stats():
+        image = np.array(Image.open('%s/nitrogen.tif' % data)).astype(float)
+        vals = image.ravel()
+        low, high = int(min(vals)), int(max(vals))
+        delta = high - low
+        image[(image < int(.2 * delta) + 4) | (image > int(.8 * delta))] = (
+            np.nan)
+        return image
+
+    nitrogen = raster.load('nitrogen')
+    raster.colormap_lut()
+
+    def render():
+        return nitrogen.render((501, 1992), width=700)
+
+    def load_columnar():
+        return datastore.load('fire'), datastore.load('nfdrs')
+    load_columnar()
+
+    rows = [dict(step=step, ms=1000 * _time(fn, repeat)) for step, fn in
+            [('pickle_load', load), ('columnar_load', load_columnar),
+             ('fire_groupby', aggregate), ('fire_cube', from_cube),
+             ('nitrogen_stats', nitrogen_stats),
+             ('nitrogen_tiles', render)]]
+    return pd.DataFrame(rows)
+
+# Benchmarks in the suite: the function, the columns identifying a row, and
+# smaller arguments for a quick run. Timing columns are those named ms or us
+# or ending in _ms.
+SUITE = {
+    'rhs': (bench_rhs, ['cohorts'], {'number': 200}),
+    'solve': (bench_solve, ['cohorts', 'horizon', 'epochs'],
+              {'cohorts': (3, 10), 'horizons': (300, 1000),
+               'epochs': (1, 10)}),
+    'methods': (bench_methods, ['regime', 'horizon', 'method'],
+                {'horizons': (300,), 'repeat': 1}),
+    'model_input': (bench_model_input, ['interventions'],
+                    {'sizes': (10, 100, 1000)}),
+    'metapopulation': (bench_metapopulation, ['regions'],
+                       {'sizes': (100, 1000)}),
+    'app_data': (bench_app_data, ['step'], {})
+}
+
+def _timings(df):
+    """Names of the timing columns of a benchmark table."""
+    return [c for c in df.columns if c in ('ms', 'us') or c.endswith('_ms')]
+
+def run_suite(names=None, quick=False):
+    """Run benchmarks from SUITE.
+
+    Arguments:
+        names: Names of the benchmarks to run; defaults to all of them.
+        quick: If True, use the smaller arguments in SUITE.
+
+    Returns: A dict, serializable as JSON, with the platform under 'meta'
+        and a list of row records per benchmark under 'results'.
+    """
+    results = {}
+    for name in names or SUITE:
+        fn, _, quick_kwargs = SUITE[name]
+        df = fn(**quick_kwargs) if quick else fn()
+        results[name] = json.loads(df.to_json(orient='records'))
+    meta = {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(),
+            'quick': quick,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'results': results}
+
+def compare(results, baseline, tolerance=1.25):
+    """Compare timings against a baseline from run_suite.
+
+    Rows are matched on the identifying columns in SUITE; rows present in
+    only one of the two are skipped.
+
+    Returns: A dataframe with one row per matched timing, giving the
+        baseline and current values, their ratio and whether the ratio
+        exceeds tolerance.
+    """
+    rows = []
+    for name, records in results['results'].items():
+        if name not in baseline['results'] or name not in SUITE:
+            continue
+        keys = SUITE[name][1]
+        current = pd.DataFrame(records).set_index(keys)
+        previous = pd.DataFrame(baseline['results'][name]).set_index(keys)
+        common = current.index.intersection(previous.index)
+        for column in _timings(current.reset_index()):
+            if column not in previous.columns:
+                continue
+            for key in common:
+                ratio = current.at[key, column] / previous.at[key, column]
+                rows.append(dict(
+                    benchmark=name, key=str(key), timing=column,
+                    baseline=previous.at[key, column],
+                    current=current.at[key, column], ratio=ratio,
+                    regressed=ratio > tolerance))
+    return pd.DataFrame(rows, columns=['benchmark', 'key', 'timing',
+                                       'baseline', 'current', 'ratio',
+                                       'regressed'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='Save the results as JSON.')
+    parser.add_argument('--baseline', help='Compare with saved results.')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Largest acceptable ratio to the baseline.')
+    parser.add_argument('--suite', action='append', choices=list(SUITE),
+                        help='Benchmark to run; repeat for several.')
+    parser.add_argument('--quick', action='store_true',
+                        help='Run smaller versions of the benchmarks.')
+    args = parser.parse_args()
+
+    results = run_suite(args.suite, args.quick)
+    for name, records in results['results'].items():
+        print('\n%s\n%s' % (name, pd.DataFrame(records).to_string(
+            index=False)))
+    if not args.suite:
+        print('\n%s' % rk4_error().to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(results, json.load(f), args.tolerance)
+        print('\n%s' % comparison.to_string(index=False))
+        if comparison.regressed.any():
+            sys.exit(1)
@@ -0,0 +1,317 @@
+"""Fit the SEIR model to observed daily cases and deaths.
+
+The fitted parameters are the probability of transmission, the initial
+fraction each of exposed and infected, and optionally the chi (or xi, for
+cohort-based interventions) of interventions in the schedule. Reported
+cases are the daily onsets of infection (exits from Exposed), times a fixed
+reporting rate; both series are treated as Poisson counts.
+
+The gradient of the negative log-likelihood comes from the forward
+sensitivity equations, dS/dt = J S + df/dtheta, integrated alongside the
+state, rather than from finite differences. Each fit is a bounded
+quasi-Newton (L-BFGS-B) search, restarted from a Latin hypercube of
+starting points, with the starts (and, for calibrate_regions, the regions)
+spread across a process pool. Solves are memoized within a fit, since the
+line search revisits points.
+
+Example:
+
+    best = calibration.calibrate(
+        cases, deaths, [(30, 70)], ['Shelter in place'], region='Europe',
+        population=1e7, fit_npis=['Shelter in place']).iloc[0]
+
+"""
+
+import collections
+import copy
+
+import numpy as np
+import pandas as pd
+import scipy.optimize
+
+import model
+import uncertainty
+
+# Bounds on the fitted parameters; interventions are bounded by BOUNDS_NPI
+BOUNDS = {
+    'prob_of_transmission': (.005, .2),
+    'initial_infected': (1e-7, .02)
+}
+BOUNDS_NPI = (.01, 1.)
+
+class Calibration(object):
+    """Poisson negative log-likelihood of observed series, with its gradient.
+
+    The search runs over x = (log beta, log initial infected, chi...), so
+    that the rate parameters are on comparable scales.
+
+    Attributes:
+        cases, deaths: Observed daily counts, with NaN for missing days
+        names: Names of the fitted parameters
+        bounds: List of (low, high) bounds on the fitted parameters
+        evaluations: Number of solves, excluding memoized ones
+
+    External methods:
+        solve: Integrate the state and its sensitivities.
+        nll: Negative log-likelihood and its gradient.
+        fit: Minimize the negative log-likelihood from a starting point.
+    """
+    def __init__(self, cases, deaths, day_ranges, selected_npis,
+                 region='Americas', population=1e6, fit_npis=(),
+                 reporting_rate=1., memo_size=64, **options):
+        """
+        Arguments:
+            cases, deaths: Observed daily counts from day 0, of equal length
+            day_ranges, selected_npis: Intervention schedule, as for
+                model.model_input
+            region: Region in model.WORLD_POP
+            population: Total population
+            fit_npis: Interventions in selected_npis whose impact is fitted
+            reporting_rate: Fraction of onsets reported as cases
+            memo_size: Number of solves to memoize
+            options: Keyword arguments passed on to the scipy ODE solver
+        """
+        self.cases = np.asarray(cases, dtype=float)
+        self.deaths = np.asarray(deaths, dtype=float)
+        if self.cases.shape != self.deaths.shape:
+            raise ValueError('Cases and deaths must cover the same days.')
+        missing = set(fit_npis) - set(selected_npis)
+        if missing:
+            raise ValueError(
+                'Fitted interventions not in the schedule: %s' %
+                sorted(missing))
+        self.day_ranges = day_ranges
+        self.selected_npis = selected_npis
+        self.region = region
+        self.population = population
+        self.fit_npis = list(fit_npis)
+        self.reporting_rate = reporting_rate
+        self.options = dict({'rtol': 1e-6}, **options)
+        self.names = list(BOUNDS) + self.fit_npis
+        self.bounds = list(BOUNDS.values()) + [BOUNDS_NPI] * len(fit_npis)
+        self.evaluations = 0
+        self._memo = collections.OrderedDict()
+        self._memo_size = memo_size
+
+        # one day past the last observation, so each daily count is a
+        # difference of two sampled states
+        self.total_days = len(self.cases) + 1
+
+    def _contacts(self, impacts):
+        """Contact matrices per epoch and their derivatives by fitted NPI.
+
+        The fitted value of an intervention is its xi if it has indices, and
+        its chi otherwise.
+
+        Returns: Arrays (epochs, cohorts, cohorts) and (fitted, epochs,
+            cohorts, cohorts), and the epoch end times.
+        """
+        contact_matrix = model.CONTACT_MATRICES_0[self.region]
+        shape = contact_matrix.shape
+        names, factors, counts, end_times = model.intervention_factors(
+            self.day_ranges, self.selected_npis, self.total_days, shape,
+            impacts)
+        n = counts[:,:,None,None]
+        powers = factors[:,None] ** n
+        contacts = contact_matrix * np.prod(powers, axis=0)
+
+        d_contacts = np.zeros((len(self.fit_npis),) + contacts.shape)
+        for k, npi in enumerate(self.fit_npis):
+            row = names.index(npi)
+            key = 'xi' if 'indices' in impacts[npi] else 'chi'
+            value = impacts[npi][key]
+            # the factor is base * value ** degree, elementwise
+            base = model.intervention_factor(
+                dict(impacts[npi], **{key: 1.}), shape)
+            degree = np.ones(shape)
+            if key == 'xi':
+                degree[:] = 0
+                for idx_pair in impacts[npi]['indices']:
+                    degree[idx_pair] += 1
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d_factor = np.where(
+                    degree > 0, base * degree * value ** (degree - 1), 0)
+                d_power = np.where(
+                    n[row] > 0, n[row] * factors[row] ** (n[row] - 1), 0)
+            others = np.prod(np.delete(powers, row, axis=0), axis=0)
+            d_contacts[k] = contact_matrix * others * d_power * d_factor
+        return contacts, d_contacts, end_times
+
+    def _initial_state(self, initial_infected):
+        """Initial state and its derivative by the initial fraction, which
+        it is linear in."""
+        state = [uncertainty.initial_state(self.region, i, self.population)
+                 for i in [initial_infected, 0, 1]]
+        return state[0].ravel(), (state[2] - state[1]).ravel()
+
+    def solve(self, theta):
+        """Integrate the state and its sensitivities to the parameters.
+
+        Arguments:
+            theta: Parameter values, in the order of names
+
+        Returns: The days, an array (states, days) and an array
+            (states, parameters, days) of sensitivities.
+        """
+        impacts = copy.deepcopy(model.NPI_IMPACTS)
+        for npi, value in zip(self.fit_npis, theta[len(BOUNDS):]):
+            impacts[npi]['xi' if 'indices' in impacts[npi] else 'chi'] = value
+        contacts, d_contacts, end_times = self._contacts(impacts)
+        # one model per epoch, so that f and jac see its contact matrix
+        models = [model.SEIRModel([contact], [end],
+                                  prob_of_transmission=theta[0])
+                  for contact, end in zip(contacts, end_times)]
+        y0, dy0 = self._initial_state(theta[1])
+        size, n_params = len(y0), len(theta)
+        s0 = np.zeros((size, n_params))
+        s0[:,1] = dy0
+
+        t_eval = np.arange(self.total_days)
+        z = model.integrate_epochs(
+            lambda k, t, z: self._augmented(models[k], t, z, d_contacts[:,k]),
+            end_times, np.concatenate([y0, s0.ravel()]), t_eval,
+            **self.options)
+        self.evaluations += 1
+        return (t_eval, z[:size],
+                z[size:].reshape(size, n_params, len(t_eval)))
+
+    def _augmented(self, seir, t, z, d_contacts):
+        """Rate of change of the state and of its sensitivities."""
+        nc, ncomp = seir.N_cohorts, seir.N_compartments
+        size = nc * ncomp
+        y, sens = z[:size], z[size:].reshape(size, -1)
+        contact = seir.contacts[0]
+        prevalence = seir.prevalence(y)
+        susceptible = y[seir.s::ncomp]
+
+        # J S, plus the explicit derivatives of the new infections
+        d_sens = seir.jac(t, y) @ sens
+        explicit = np.empty((nc, sens.shape[1]))
+        explicit[:,0] = susceptible * (contact @ prevalence)
+        explicit[:,1] = 0
+        explicit[:,2:] = (seir.beta * susceptible[:,None] *
+                          (d_contacts @ prevalence).T)
+        d_sens[seir.s::ncomp] -= explicit
+        d_sens[seir.e::ncomp] += explicit
+        return np.concatenate([seir.f(t, y), d_sens.ravel()])
+
+    def nll(self, x):
+        """Negative log-likelihood, up to a constant, and its gradient in x."""
+        key = np.asarray(x, dtype=float).tobytes()
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            return self._memo[key]
+
+        theta = self.to_parameters(x)
+        _, y, sens = self.solve(theta)
+        # cumulative onsets are everyone past Exposed
+        ncomp = len(model.COMPARTMENTS)
+        onsets = np.zeros(len(y))
+        for c in model.COMPARTMENTS[model.COMPARTMENTS.index('Exposed')+1:]:
+            onsets[model.COMPARTMENTS.index(c)::ncomp] = 1
+        dead = np.zeros(len(y))
+        dead[model.COMPARTMENTS.index('Dead')::ncomp] = 1
+
+        value, gradient = 0., np.zeros(len(theta))
+        for weights, observed, scale in [
+                (onsets, self.cases, self.reporting_rate),
+                (dead, self.deaths, 1.)]:
+            mu = scale * np.diff(weights @ y)
+            d_mu = scale * np.diff(np.tensordot(weights, sens, 1), axis=1)
+            mu = np.maximum(mu, 1e-9)
+            seen = ~np.isnan(observed)
+            k = observed[seen]
+            value += np.sum(mu[seen] - k * np.log(mu[seen]))
+            gradient += d_mu[:,seen] @ (1 - k / mu[seen])
+
+        # chain rule for the log-scaled rate parameters
+        gradient[:len(BOUNDS)] *= theta[:len(BOUNDS)]
+        result = (value, gradient)
+        self._memo[key] = result
+        if len(self._memo) > self._memo_size:
+            self._memo.popitem(last=False)
+        return result
+
+    def to_parameters(self, x):
+        """Map a point in the search space to parameter values."""
+        theta = np.array(x, dtype=float)
+        theta[:len(BOUNDS)] = np.exp(theta[:len(BOUNDS)])
+        return theta
+
+    def to_search(self, theta):
+        """Map parameter values to a point in the search space."""
+        x = np.array(theta, dtype=float)
+        x[:len(BOUNDS)] = np.log(x[:len(BOUNDS)])
+        return x
+
+    def fit(self, theta0, **options):
+        """Minimize the negative log-likelihood from theta0.
+
+        Returns: The scipy.optimize.OptimizeResult, with x mapped back to
+            parameter values.
+        """
+        bounds = [tuple(self.to_search(b)) if i < len(BOUNDS) else b
+                  for i, b in enumerate(np.array(self.bounds))]
+        result = scipy.optimize.minimize(
+            self.nll, self.to_search(theta0), jac=True, method='L-BFGS-B',
+            bounds=bounds, options=options)
+        result.x = self.to_parameters(result.x)
+        return result
+
+def _starts(calibration, n_starts, seed):
+    """Latin hypercube of starting points, log-uniform in the rates."""
+    ranges = {name: tuple(np.log(b)) if name in BOUNDS else b
+              for name, b in zip(calibration.names, calibration.bounds)}
+    x = uncertainty.sample_parameters(ranges, n_starts, 'lhs', seed).values
+    return [calibration.to_parameters(row) for row in x]
+
+def calibrate_regions(problems, n_starts=8, processes=None, seed=None):
+    """Fit many regions, with every (region, start) pair in one pool.
+
+    Arguments:
+        problems: Dict of {name: dict of Calibration keyword arguments}
+        n_starts: Number of starting points per region
+        processes: Number of worker processes; defaults to the CPU count
+        seed: Seed for the starting points
+
+    Returns: A dataframe with one row per start, sorted by region and then
+        by negative log-likelihood, with the fitted parameters, nll, success,
+        iterations and solves.
+    """
+    jobs = []
+    for name, kwargs in problems.items():
+        calibration = Calibration(**kwargs)
+        for k, theta0 in enumerate(_starts(calibration, n_starts, seed)):
+            jobs.append((name, k, kwargs, theta0))
+    rows = list(uncertainty.map_chunks(_fit, jobs, processes))
+    return pd.DataFrame(rows).sort_values(
+        ['region', 'nll']).reset_index(drop=True)
+
+def _fit(name, k, kwargs, theta0):
+    calibration = Calibration(**kwargs)
+    result = calibration.fit(theta0)
+    return dict({'region': name, 'start': k},
+                **dict(zip(calibration.names, result.x)),
+                nll=result.fun, success=result.success, iterations=result.nit,
+                solves=calibration.evaluations)
+
+def calibrate(cases, deaths, day_ranges, selected_npis, region='Americas',
+              population=1e6, fit_npis=(), n_starts=8, processes=None,
+              seed=None, **kwargs):
+    """Fit one region from several starting points.
+
+    Arguments:
+        cases, deaths, day_ranges, selected_npis, region, population,
+            fit_npis: cf. Calibration
+        n_starts: Number of starting points
+        processes: Number of worker processes; defaults to the CPU count
+        seed: Seed for the starting points
+        kwargs: Further Calibration keyword arguments
+
+    Returns: A dataframe with one row per start, best first, cf.
+        calibrate_regions.
+    """
+    problem = dict(cases=cases, deaths=deaths, day_ranges=day_ranges,
+                   selected_npis=selected_npis, region=region,
+                   population=population, fit_npis=fit_npis, **kwargs)
+    return calibrate_regions({region: problem}, n_starts, processes, seed)
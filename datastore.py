@@ -0,0 +1,122 @@
+"""Columnar, memory-mapped copies of the app's pickled datasets.
+
+Each dataset is converted once from its pickle into one .npy file per
+column, with typed columns: dates as datetime64, years and causes as small
+integers. Loading memory-maps only the requested columns, so a cold start
+reads no more than the pages a view touches, and every worker process
+shares one page-cache copy. A conversion is redone when its pickle is newer.
+
+Convert ahead of time (e.g. in the Docker build) with:
+
+    python datastore.py
+
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+DIRECTORY = 'data/columnar'
+
+# Source pickle and column types of each dataset. Missing values in integer
+# columns are stored as 0, which is not a valid cause code.
+DATASETS = {
+    'nfdrs': ('data/nfdrs.pkl',
+              {'date': 'datetime64[s]', 'bi': 'float32', 'fm100': 'float32'}),
+    'fire': ('data/firedata.pkl',
+             {'YEAR': 'int16', 'GIS_ACRES': 'float64', 'CAUSE': 'int8'})
+}
+
+def _path(name, directory, filename):
+    return os.path.join(directory, name, filename)
+
+def temporary(path):
+    """The name a file is written under before publish renames it.
+
+    The name holds the process and thread id, so concurrent conversions
+    (e.g. two app sessions, which are threads of one process) each write
+    their own file; publish must be called from the writing thread.
+    """
+    root, ext = os.path.splitext(path)
+    return '%s.%d.%d.tmp%s' % (root, os.getpid(), threading.get_ident(), ext)
+
+def publish(*paths):
+    """Rename files written under their temporary names into place.
+
+    Converted copies are written this way, with meta.json published last,
+    so concurrent readers never see a partial file and a copy is current
+    only once all of it is in place.
+    """
+    for path in paths:
+        os.replace(temporary(path), path)
+
+def write_meta(folder, source, **fields):
+    """Publish the meta.json of a copy converted from source, stamped with
+    the source's modification time."""
+    meta = dict(fields, source=source,
+                source_mtime=os.path.getmtime(source))
+    path = os.path.join(folder, 'meta.json')
+    with open(temporary(path), 'w') as f:
+        json.dump(meta, f, indent=1)
+    publish(path)
+
+def read_meta(folder):
+    """The meta.json of a converted copy, or None if there is none."""
+    try:
+        with open(os.path.join(folder, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def is_fresh(folder, source, **fields):
+    """Whether a converted copy exists, has the given meta fields and is
+    as new as its source."""
+    meta = read_meta(folder)
+    return (meta is not None and
+            all(meta.get(k) == v for k, v in fields.items()) and
+            meta['source_mtime'] >= os.path.getmtime(source))
+
+def convert(name, directory=DIRECTORY):
+    """Convert a dataset from its pickle to typed .npy columns."""
+    source, dtypes = DATASETS[name]
+    df = pd.read_pickle(source)
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+    paths = []
+    for column, dtype in dtypes.items():
+        values = df[column]
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            values = values.fillna(0)
+        paths.append(_path(name, directory, column + '.npy'))
+        np.save(temporary(paths[-1]), values.to_numpy().astype(dtype))
+    publish(*paths)
+    write_meta(os.path.join(directory, name), source, rows=len(df),
+               columns=dtypes)
+
+def is_current(name, directory=DIRECTORY):
+    """Whether the columnar copy exists and is as new as its pickle."""
+    source, dtypes = DATASETS[name]
+    return is_fresh(os.path.join(directory, name), source, columns=dtypes)
+
+def load(name, columns=None, directory=DIRECTORY):
+    """Load columns of a dataset as a dataframe over read-only memory maps.
+
+    Arguments:
+        name: Dataset name in DATASETS
+        columns: Columns to load; defaults to all of them.
+        directory: Directory of the columnar copies
+
+    Returns: A dataframe whose columns are backed by the .npy files.
+    """
+    if not is_current(name, directory):
+        convert(name, directory)
+    columns = list(DATASETS[name][1]) if columns is None else columns
+    return pd.DataFrame(
+        {c: np.load(_path(name, directory, c + '.npy'), mmap_mode='r')
+         for c in columns}, copy=False)
+
+if __name__ == '__main__':
+    for name in DATASETS:
+        convert(name)
@@ -0,0 +1,143 @@
+"""Decimation of long series for charting, sized to the chart's pixels.
+
+A chart a few hundred pixels wide cannot show more than a few points per
+pixel column, so sending every point of a long series only inflates the
+chart spec. Two decimations keep the shape of the series:
+
+    lttb: Largest-Triangle-Three-Buckets; one point per bucket of equal
+        count, chosen to form the largest triangle with its neighbours,
+        which keeps peaks and troughs.
+    minmax: The lowest and highest point in each of equal-width buckets,
+        e.g. one bucket per pixel column, which keeps the envelope exactly.
+
+Both return indices into the series, so any columns may be taken with
+them. A Pyramid precomputes decimations at doubling sizes, so each request
+picks a level instead of decimating again, and the payload is bounded by
+the chart width however long the series grows.
+
+Example:
+
+    levels = decimate.Pyramid(nfdrs_df.date.values, nfdrs_df.bi.values)
+    chart_df = nfdrs_df.iloc[levels.select(2 * width)]
+
+"""
+
+import numpy as np
+
+METHODS = ['lttb', 'minmax']
+
+def _as_float(x):
+    """Numbers or datetimes as floats measured from the first value."""
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype('datetime64[s]').astype(np.int64)
+    x = x.astype(float)
+    return x - x[0] if len(x) else x
+
+def lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets decimation.
+
+    The first and last points are kept; the others are split into n_out - 2
+    buckets of equal count, and from each bucket the point forming the
+    largest triangle with the point kept from the previous bucket and the
+    mean of the next bucket is kept.
+
+    Arguments:
+        x: Sorted times or positions, numbers or datetime64
+        y: Values, without NaNs
+        n_out: Number of points to keep
+
+    Returns: Sorted integer indices of the kept points.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x, y = _as_float(x), np.asarray(y, dtype=float)
+    every = (n - 2) / (n_out - 2)
+    edges = np.append(
+        (np.arange(n_out - 1) * every).astype(int) + 1, n)
+    edges[-2] = n - 1
+    # mean of each bucket, from prefix sums; the last "bucket" is the last
+    # point
+    sum_x = np.concatenate([[0.], np.cumsum(x)])
+    sum_y = np.concatenate([[0.], np.cumsum(y)])
+    counts = np.diff(edges)
+    mean_x = (sum_x[edges[1:]] - sum_x[edges[:-1]]) / counts
+    mean_y = (sum_y[edges[1:]] - sum_y[edges[:-1]]) / counts
+
+    kept = np.empty(n_out, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i+1]
+        area = np.abs((x[a] - mean_x[i+1]) * (y[lo:hi] - y[a]) -
+                      (x[a] - x[lo:hi]) * (mean_y[i+1] - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[i+1] = a
+    return kept
+
+def minmax(x, y, n_buckets):
+    """The lowest and highest point in each of equal-width buckets of x.
+
+    With one bucket per pixel column, the decimated series covers exactly
+    the pixels of the full one.
+
+    Arguments:
+        x: Sorted times or positions, numbers or datetime64
+        y: Values, without NaNs
+        n_buckets: Number of buckets across the range of x
+
+    Returns: Sorted integer indices of the kept points, at most
+        2 * n_buckets of them.
+    """
+    n = len(y)
+    if 2 * n_buckets >= n or n_buckets < 1:
+        return np.arange(n)
+    x, y = _as_float(x), np.asarray(y, dtype=float)
+    span = x[-1] or 1.
+    bucket = np.minimum((x / span * n_buckets).astype(int), n_buckets - 1)
+    # sort by value within each bucket; its first and last are min and max
+    order = np.lexsort((y, bucket))
+    starts = np.flatnonzero(np.diff(bucket[order], prepend=-1))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate([order[starts], order[ends]]))
+
+class Pyramid(object):
+    """Decimations of a series at doubling sizes, computed once.
+
+    Level k keeps about base * 2**k points (for minmax, base * 2**k
+    buckets); the last level is the full series.
+
+    Attributes:
+        method: 'lttb' or 'minmax'
+        levels: List of sorted index arrays, from coarsest to full
+
+    External methods:
+        select: Indices of the coarsest level with enough points.
+    """
+    def __init__(self, x, y, method='lttb', base=256):
+        """
+        Arguments:
+            x: Sorted times or positions, numbers or datetime64
+            y: Values, without NaNs
+            method: 'lttb' or 'minmax'
+            base: Size of the coarsest level
+        """
+        if method not in METHODS:
+            raise ValueError('Unknown decimation method: %s' % method)
+        self.method = method
+        decimation = lttb if method == 'lttb' else minmax
+        n = len(y)
+        self.levels = []
+        size = base
+        while (size if method == 'lttb' else 2 * size) < n:
+            self.levels.append(decimation(x, y, size))
+            size *= 2
+        self.levels.append(np.arange(n))
+
+    def select(self, n_points):
+        """Indices of the coarsest level with at least n_points points."""
+        for indices in self.levels:
+            if len(indices) >= n_points:
+                return indices
+        return self.levels[-1]
@@ -0,0 +1,201 @@
+"""Regression discontinuity at any break point, from prefix sums.
+
+Prefix sums of 1, t, y, t^2, t*y and y^2 over a sorted series give the
+least-squares line, its residual sum of squares and standard errors for any
+contiguous range in O(1). Splitting the series at a break point is two such
+ranges, so every candidate break can be tested at once, vectorized, and the
+best break found by a scan.
+
+Times are measured in years from the mean of the series, which keeps the
+prefix sums well conditioned; dates may be given as datetime64.
+
+Example:
+
+    engine = discontinuity.BreakRegression(nfdrs_df.date, nfdrs_df.bi)
+    engine.test([np.datetime64('1990-01-01')])
+    engine.best_break()
+
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+DAYS_PER_YEAR = 365.25
+
+# Fewest points on which a line and its standard errors are fitted
+MIN_POINTS = 3
+
+class BreakRegression(object):
+    """Least-squares lines on either side of any break point.
+
+    Attributes:
+        t: Sorted times, in years from origin
+        y: Values, in the order of t
+        origin: The time from which t is measured, as given (e.g. a
+            datetime64) or as a number
+
+    External methods:
+        fit: The line through a range of times.
+        test: Lines either side of break points, and tests of the jump.
+        best_break: The break point that best separates two lines.
+        segments: Endpoints of the two lines about a break, for a chart.
+    """
+    def __init__(self, t, y):
+        t = np.asarray(t)
+        self._dates = np.issubdtype(t.dtype, np.datetime64)
+        days = (t.astype('datetime64[s]').astype(np.int64) / 86400.
+                if self._dates else t.astype(float))
+        order = np.argsort(days, kind='stable')
+        days, y = days[order], np.asarray(y, dtype=float)[order]
+        self._origin_days = days.mean()
+        self.origin = (self._to_time(self._origin_days) if self._dates
+                       else self._origin_days)
+        self.t = (days - self._origin_days) / (
+            DAYS_PER_YEAR if self._dates else 1.)
+        self.y = y
+        terms = [np.ones_like(y), self.t, y, self.t ** 2, self.t * y, y ** 2]
+        self._sums = np.zeros((len(terms), len(y) + 1))
+        np.cumsum(terms, axis=1, out=self._sums[:,1:])
+
+    def _to_time(self, days):
+        """Days since the Unix epoch as datetime64[s]."""
+        # rounded, as a cast would truncate e.g. 23:59:59.99 to 23:59:59
+        return np.rint(np.asarray(days) * 86400).astype(np.int64).astype(
+            'datetime64[s]')
+
+    def _position(self, times):
+        """Convert times as given to years from origin."""
+        times = np.asarray(times)
+        if self._dates:
+            days = times.astype('datetime64[s]').astype(np.int64) / 86400.
+            return (days - self._origin_days) / DAYS_PER_YEAR
+        return times.astype(float) - self._origin_days
+
+    def _from_position(self, t):
+        """Convert years from origin back to times as given."""
+        if self._dates:
+            return self._to_time(self._origin_days + t * DAYS_PER_YEAR)
+        return t + self._origin_days
+
+    def _fit(self, lo, hi):
+        """Fit lines over the index ranges [lo, hi), elementwise; ranges of
+        fewer than MIN_POINTS points give NaN."""
+        lo, hi = np.broadcast_arrays(lo, hi)
+        s = self._sums[:,hi] - self._sums[:,lo]
+        n, st, sy, stt, sty, syy = s
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_t, mean_y = st / n, sy / n
+            sxx = stt - st * mean_t
+            sxy = sty - st * mean_y
+            slope = sxy / sxx
+            intercept = mean_y - slope * mean_t
+            sse = np.maximum(syy - sy * mean_y - slope * sxy, 0)
+            sigma2 = sse / (n - 2)
+            slope_se = np.sqrt(sigma2 / sxx)
+        fit = {'n': n, 'slope': slope, 'intercept': intercept, 'sse': sse,
+               'sigma2': sigma2, 'slope_se': slope_se, 'mean_t': mean_t,
+               'sxx': sxx}
+        # too few points for a line with standard errors
+        short = n < MIN_POINTS
+        for k in fit:
+            if k != 'n':
+                fit[k] = np.where(short, np.nan, fit[k])
+        return fit
+
+    def _value_se(self, fit, t):
+        """Standard error of the fitted value of a line at t."""
+        return np.sqrt(fit['sigma2'] * (
+            1 / fit['n'] + (t - fit['mean_t']) ** 2 / fit['sxx']))
+
+    def fit(self, start=None, end=None):
+        """The line through the points with start <= t < end.
+
+        Returns: A dict with n, slope (per year, for dates), intercept (at
+            origin), sse and slope_se.
+        """
+        lo = 0 if start is None else np.searchsorted(
+            self.t, self._position(start))
+        hi = len(self.t) if end is None else np.searchsorted(
+            self.t, self._position(end))
+        fit = self._fit(lo, hi)
+        return {k: float(fit[k]) for k in
+                ['n', 'slope', 'intercept', 'sse', 'slope_se']}
+
+    def test(self, breaks):
+        """Fit lines either side of each break and test for a discontinuity.
+
+        The jump is the difference of the two lines at the break, tested
+        with its standard error from both sides (Welch); the Chow test
+        compares the two lines with a single line through all points.
+
+        Arguments:
+            breaks: Break points, as times; the left side is t < break.
+
+        Returns: A dataframe with one row per break.
+        """
+        breaks = np.atleast_1d(breaks)
+        t_break = self._position(breaks)
+        k = np.searchsorted(self.t, t_break)
+        n = len(self.t)
+        left, right = self._fit(0, k), self._fit(k, n)
+        pooled = self._fit(0, n)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jump = (right['intercept'] + right['slope'] * t_break -
+                    left['intercept'] - left['slope'] * t_break)
+            se_left = self._value_se(left, t_break)
+            se_right = self._value_se(right, t_break)
+            jump_se = np.sqrt(se_left ** 2 + se_right ** 2)
+            # Welch-Satterthwaite degrees of freedom
+            dof = jump_se ** 4 / (se_left ** 4 / (left['n'] - 2) +
+                                  se_right ** 4 / (right['n'] - 2))
+            jump_p = 2 * scipy.stats.t.sf(np.abs(jump / jump_se), dof)
+            sse = left['sse'] + right['sse']
+            chow_f = ((pooled['sse'] - sse) / 2) / (sse / (n - 4))
+            chow_p = scipy.stats.f.sf(chow_f, 2, n - 4)
+
+        return pd.DataFrame({
+            'break': breaks, 'n_left': left['n'], 'n_right': right['n'],
+            'slope_left': left['slope'], 'slope_right': right['slope'],
+            'slope_se_left': left['slope_se'],
+            'slope_se_right': right['slope_se'],
+            'value_left': left['intercept'] + left['slope'] * t_break,
+            'value_right': right['intercept'] + right['slope'] * t_break,
+            'jump': jump, 'jump_se': jump_se, 'jump_p': jump_p,
+            'chow_f': chow_f, 'chow_p': chow_p})
+
+    def best_break(self, min_size=365):
+        """The break point with the largest Chow statistic.
+
+        Every point between the first and last min_size points is a
+        candidate, so this is one vectorized scan of the series.
+
+        Returns: The row of test for the best break.
+        """
+        if len(self.t) < 2 * min_size + 1:
+            raise ValueError('The series is too short for min_size.')
+        candidates = self._from_position(self.t[min_size:-min_size])
+        tests = self.test(np.unique(candidates))
+        return tests.loc[tests.chow_f.idxmax()]
+
+    def segments(self, break_point):
+        """Endpoints of the lines either side of a break, for a chart.
+
+        Returns: A dataframe with columns t, y and side ('left', 'right');
+            a side with fewer than MIN_POINTS points has no line.
+        """
+        t_break = self._position(break_point)
+        k = np.searchsorted(self.t, t_break)
+        rows = []
+        for side, lo, hi, ends in [('left', 0, k, (self.t[0], t_break)),
+                                   ('right', k, len(self.t),
+                                    (t_break, self.t[-1]))]:
+            if hi - lo < MIN_POINTS:
+                continue
+            fit = self._fit(lo, hi)
+            for t in ends:
+                rows.append({'t': self._from_position(t),
+                             'y': fit['intercept'] + fit['slope'] * t,
+                             'side': side})
+        return pd.DataFrame(rows, columns=['t', 'y', 'side'])
@@ -15,9 +15,18 @@ disease.
 
 """
 
+import bisect
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
 import numpy as np
 import pandas as pd
 import scipy.integrate
+import scipy.sparse
 
 COMPARTMENTS = ['Susceptible', 'Exposed', 'Infected', 'Severely Infected',
                     'Recovered', 'Dead']
@@ -71,6 +80,166 @@ NPI_IMPACTS = {
 }
 
 
+# Implicit solvers, which are supplied with the analytic Jacobian
+IMPLICIT_METHODS = ['BDF', 'Radau', 'LSODA']
+
+# Fixed-step integrators, implemented here rather than in scipy
+FIXED_STEP_METHODS = ['RK4']
+
+# Upper bound on h times the fastest rate for the fixed-step RK4 integrator.
+# At this setting the RK4 solution stays within 1e-4 of the total population
+# of a tight-tolerance solve_ivp reference, cf. test_model.py.
+RK4_STEP_RATE = 0.5
+
+SOLVER_STATS = ['nfev', 'njev', 'nlu', 'accepted_steps', 'rejected_steps']
+
+# Scalar outcomes of a solve, cf. SEIRModel.solve_summary. Peak infected
+# counts the Infected compartment summed over cohorts; the attack rate is
+# the fraction of the population no longer susceptible at the horizon.
+Summary = collections.namedtuple(
+    'Summary',
+    ['peak_infected', 'peak_day', 'attack_rate', 'cumulative_deaths'])
+
+def _integrate(fun, t_span, y0, t_eval, method='RK45', **options):
+    """Step a scipy ODE solver across t_span, sampling the solution at t_eval.
+
+    This is equivalent to solve_ivp(fun, t_span, y0, t_eval=t_eval), but it
+    drives the solver directly so that the cost of the integration can be
+    counted. Rejected steps are only known for the explicit Runge-Kutta
+    methods, which spend a fixed number of evaluations per attempted step;
+    they are reported as None otherwise.
+
+    Returns: An array (len(y0), len(t_eval)) of sampled states, the state at
+        the end of t_span, the step size the solver would have tried next,
+        and a dict of solver statistics.
+    """
+    if isinstance(method, str):
+        method = getattr(scipy.integrate, method)
+    solver = method(fun, t_span[0], y0, t_span[1], **options)
+    n_stages = getattr(solver, 'n_stages', None)
+
+    y = np.empty((len(y0), len(t_eval)))
+    accepted, rejected, i = 0, 0, 0
+    h_next = options.get('first_step')
+    while solver.status == 'running':
+        nfev = solver.nfev
+        h_next = getattr(solver, 'h_abs', h_next)
+        message = solver.step()
+        if solver.status == 'failed':
+            raise RuntimeError(message)
+        accepted += 1
+        if n_stages:
+            rejected += (solver.nfev - nfev) // n_stages - 1
+
+        # sample the dense output at the requested times within this step
+        i_new = np.searchsorted(t_eval, solver.t, side='right')
+        if i_new > i:
+            y[:,i:i_new] = solver.dense_output()(t_eval[i:i_new])
+            i = i_new
+
+    stats = {'nfev': int(solver.nfev), 'njev': int(solver.njev),
+             'nlu': int(solver.nlu),
+             'accepted_steps': accepted,
+             'rejected_steps': rejected if n_stages else None}
+    return y, solver.y, h_next, stats
+
+def integrate_epochs(fun, epoch_end_times, y0, t_eval, t_start=0,
+                     **options):
+    """Integrate a system whose rates change at epoch boundaries.
+
+    Each epoch is integrated separately, starting with the step size reached
+    in the previous one, cf. _carry_step.
+
+    Arguments:
+        fun: Function fun(k, t, y) giving dy/dt in epoch k
+        epoch_end_times: End time of each epoch; epochs ending by t_start
+            are skipped
+        y0: State at t_start
+        t_eval: Sorted times from t_start at which to sample the solution
+        t_start: Time at which the state is y0
+        options: Keyword arguments passed on to the scipy ODE solver
+
+    Returns: An array (len(y0), len(t_eval)) of sampled states.
+    """
+    y = np.empty((len(y0), len(t_eval)))
+    start, y_start, h = t_start, y0, None
+    for k, end in enumerate(epoch_end_times):
+        if end <= start:
+            continue
+        lo, hi = np.searchsorted(t_eval, [start, end])
+        y[:,lo:hi], y_start, h, _ = _integrate(
+            lambda t, y, k=k: fun(k, t, y), (start, end), y_start,
+            t_eval[lo:hi], **_carry_step(options, h, end - start))
+        start = end
+    return y
+
+def _carry_step(options, h, span):
+    """Start the next epoch with the step size reached in the previous one.
+
+    Restarting the solver at every epoch boundary would otherwise pay for a
+    fresh initial step selection and a ramp-up from a tiny first step.
+    """
+    if h is None or 'first_step' in options:
+        return options
+    return dict(options, first_step=min(h, span))
+
+def _accumulate(stats, new_stats):
+    """Add solver statistics from new_stats into stats, in place."""
+    for k, v in new_stats.items():
+        stats[k] = None if v is None or stats[k] is None else stats[k] + v
+
+class Profile(object):
+    """Timings and counts gathered by an instrumented SEIRModel.
+
+    Attributes:
+        epochs: List of dicts, one per integrated epoch, with the number of
+            its solve, its span, wall time and solver statistics
+        seconds: Dict of wall time by activity: 'integration', 'rhs',
+            'fetch_contact' and 'dataframe'
+        calls: Dict of numbers of calls by activity
+        solves: Number of solves
+        cache_hits: Number of solves served by a SolutionCache
+
+    External methods:
+        wrap: Time and count the calls of a function.
+        report: Return everything as a structured dict.
+        epochs_frame: Return the per-epoch records as a dataframe.
+    """
+    def __init__(self):
+        self.epochs = []
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.solves = 0
+        self.cache_hits = 0
+
+    def wrap(self, fn, name):
+        """Return fn, timing and counting its calls under name."""
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+        return timed
+
+    def add_epoch(self, start, end, seconds, stats):
+        """Record the integration of one epoch."""
+        self.epochs.append(dict(solve=self.solves, start=float(start),
+                                end=float(end), seconds=seconds, **stats))
+        self.seconds['integration'] += seconds
+
+    def report(self):
+        """Return the timings and counts as a dict of plain values."""
+        return {'solves': self.solves, 'cache_hits': self.cache_hits,
+                'seconds': dict(self.seconds), 'calls': dict(self.calls),
+                'epochs': list(self.epochs)}
+
+    def epochs_frame(self):
+        """Return the per-epoch records as a dataframe."""
+        return pd.DataFrame(self.epochs, columns=[
+            'solve', 'start', 'end', 'seconds'] + SOLVER_STATS)
+
 class SEIRModel(object):
     """Class to solve an age-structured SEIR Compartmental model.
 
@@ -87,10 +256,23 @@ class SEIRModel(object):
         compartments: List of names of compartments
         N_compartments: Number of compartments 
         s, e, i, m, r, d: Indices of the compartments in the state vector y(t) 
+        restart_time: Day from which the last piecewise or fixed-step solve
+            integrated; earlier days were reused from the previous solve.
+        profile: Profile of the solves since instrument() was called, or
+            None if the model is not instrumented
 
     External methods: 
         f: Function giving the rate of change in the state variable y(t).
+        jac: Jacobian of f with respect to y(t).
+        contact: Contact matrix in effect at a time.
+        parameters: Keyword arguments that rebuild the model's rates.
+        prevalence: Infectious fraction of each cohort.
         solve: Integrate the coupled differential equations.
+        reschedule: Replace the epoch schedule, keeping state checkpoints.
+        instrument: Turn the collection of a Profile on or off.
+        integration_savings: Compare the cost of piecewise and single-span
+            integration.
+        solve_summary: Solve for summary outcomes only.
         solve_to_dataframe: Solve and output a tidy dataframe.
     """
     def __init__(self, contact_matrices, epoch_end_times,
@@ -107,7 +289,7 @@ class SEIRModel(object):
         self.beta = prob_of_transmission
         self.gamma = 1/duration_of_infection
         self.delta = 1/time_to_death
-        self.kappa = mortality_rates
+        self.kappa = np.asarray(mortality_rates, dtype=float)
         self.N_cohorts = N_cohorts
 		
         # N.B. hard-coded values. The function f() assumes these compartments.
@@ -115,44 +297,498 @@ class SEIRModel(object):
         self.N_compartments = len(COMPARTMENTS)
         self.s, self.e, self.i, self.m, self.r, self.d = list(
             range(len(COMPARTMENTS)))
+
+        # state checkpoints at epoch boundaries from the last solve
+        self._checkpoints = None
+        self.restart_time = 0
+        self.profile = None
+
+        # cohort-wise rates out of the Exposed compartment
+        self._alpha_survive = self.alpha * (1 - self.kappa)
+        self._alpha_die = self.alpha * self.kappa
+
+        # CSC layout of the sparse Jacobian, built on first use
+        self._sparse_layout = None
 													   
     def _fetch_contact(self, t):
         """Fetch the contact matrix for given time t."""
-        for end_time, contact in zip(self.epoch_end_times, self.contacts): 
-            if t <= end_time: 
-                return contact      
+        k = bisect.bisect_left(self.epoch_end_times, t)
+        return self.contacts[min(k, len(self.contacts) - 1)]
+
+    def contact(self, t):
+        """The contact matrix in effect at time t (days)."""
+        return self._fetch_contact(t)
+
+    def parameters(self):
+        """Keyword arguments that, with contacts and epoch_end_times, build
+        a model with the same rates, e.g. in a worker process."""
+        return {'incubation_period': 1 / self.alpha,
+                'prob_of_transmission': self.beta,
+                'duration_of_infection': 1 / self.gamma,
+                'time_to_death': 1 / self.delta,
+                'mortality_rates': self.kappa, 'N_cohorts': self.N_cohorts}
 		
-    def f(self, t, y):
-        """Function giving the rate of change in the state variable y(t)."""
+    def f(self, t, y, out=None):
+        """Function giving the rate of change in the state variable y(t).
+
+        Arguments:
+            t: Time (days)
+            y: Flattened state vector of length N_cohorts * N_compartments
+            out: Optional preallocated array to receive the result. The
+                caller owns the buffer; solve_ivp keeps references to
+                returned derivatives, so only pass one from a custom stepper.
+
+        Returns: The flattened derivative dy/dt.
+        """
+        return self._rhs(y, self._fetch_contact(t), out)
+
+    def prevalence(self, y):
+        """The infectious fraction (I+M)/N of each cohort in state y."""
+        y = y.reshape(self.N_cohorts, self.N_compartments)
+        return (y[:,self.i] + y[:,self.m]) / y.sum(axis=1)
+
+    def _rhs(self, y, contact, out=None):
+        """Evaluate dy/dt for a fixed contact matrix.
+
+        Each compartment is updated as a slice over cohorts, so apart from
+        the force of infection mat-vec the cost is linear in the number of
+        cohorts.
+        """
         y = y.reshape(self.N_cohorts, self.N_compartments)
-        dy = np.zeros((self.N_cohorts, self.N_compartments))
-        contact = self._fetch_contact(t)
-        for a in range(self.N_cohorts):
-            infection_rate = np.sum([
-                self.beta * contact[a,b] * (y[b,self.i] + y[b,self.m]) /
-                    np.sum(y[b,:]) for b in range(self.N_cohorts)])
-            dy[a,self.s] = -y[a,self.s] * infection_rate
-            dy[a,self.e] = (y[a,self.s] * infection_rate - 
-                            self.alpha * y[a, self.e])
-            dy[a,self.i] = (self.alpha * (1-self.kappa[a]) * y[a, self.e] -
-                            self.gamma * y[a, self.i])
-            dy[a,self.m] = (self.alpha * self.kappa[a] * y[a, self.e] -
-                            self.delta * y[a, self.m])            
-            dy[a,self.r] = self.gamma  * y[a, self.i]
-            dy[a,self.d] = self.delta * y[a, self.m]
-        return dy.flatten()
-	
-    def solve(self, y0):
-        """Integrate the coupled differential equations."""
-        sol = scipy.integrate.solve_ivp(
-            self.f, (0, self.epoch_end_times[-1]), y0, 
-            t_eval=np.arange(self.epoch_end_times[-1]))
-        return sol.t, sol.y
-
-    def solve_to_dataframe(self, y0, detailed_output=False):
-        """Solve and output a tidy dataframe."""
-        t, y = self.solve(y0)
+        if out is None:
+            dy = np.empty_like(y)
+        else:
+            dy = out.reshape(self.N_cohorts, self.N_compartments)
+        exposed, infected, severe = y[:,self.e], y[:,self.i], y[:,self.m]
+
+        # force of infection on each cohort, as a single mat-vec
+        infection_rate = self.beta * (
+            contact @ ((infected + severe) / y.sum(axis=1)))
+        new_infections = y[:,self.s] * infection_rate
+        np.negative(new_infections, out=dy[:,self.s])
+        np.subtract(new_infections, self.alpha * exposed, out=dy[:,self.e])
+        np.subtract(self._alpha_survive * exposed, self.gamma * infected,
+                    out=dy[:,self.i])
+        np.subtract(self._alpha_die * exposed, self.delta * severe,
+                    out=dy[:,self.m])
+        np.multiply(self.gamma, infected, out=dy[:,self.r])
+        np.multiply(self.delta, severe, out=dy[:,self.d])
+        return dy.reshape(-1)
+
+    def jac(self, t, y, sparse=False):
+        """Jacobian of f with respect to the state y(t).
+
+        Arguments:
+            t: Time (days)
+            y: Flattened state vector
+            sparse: If True, return a scipy.sparse CSC matrix. Only the
+                Susceptible and Exposed rows couple cohorts; the rest is the
+                constant cohort-diagonal part, so about 2 / N_compartments
+                of the entries are stored.
+
+        Returns: Array of shape (len(y), len(y))
+        """
+        if sparse:
+            return self._sparse_jac(y, self._fetch_contact(t))
+        return self._jac(y, self._fetch_contact(t))
+
+    def _linear_terms(self):
+        """The constant, cohort-diagonal part of the Jacobian, as arrays
+        (cohorts,) of rows, columns and values per transition."""
+        cohorts = np.arange(self.N_cohorts) * self.N_compartments
+        terms = [(self.e, self.e, -self.alpha),
+                 (self.i, self.e, self._alpha_survive),
+                 (self.i, self.i, -self.gamma),
+                 (self.m, self.e, self._alpha_die),
+                 (self.m, self.m, -self.delta),
+                 (self.r, self.i, self.gamma),
+                 (self.d, self.m, self.delta)]
+        return [(cohorts + row, cohorts + col,
+                 np.broadcast_to(value, (self.N_cohorts,)))
+                for row, col, value in terms]
+
+    def _sparse_pattern(self):
+        """The CSC layout of the Jacobian: every column of the Susceptible
+        and Exposed rows, and the linear transitions in the other rows.
+
+        Returns: The indices and indptr of the layout, its data with the
+            linear part filled in, and the positions in the data of the
+            Susceptible and Exposed rows, as arrays (cohorts, size).
+        """
+        if self._sparse_layout is not None:
+            return self._sparse_layout
+        size = self.N_cohorts * self.N_compartments
+        cohorts = np.arange(self.N_cohorts) * self.N_compartments
+        rows = [np.repeat(cohorts + self.s, size),
+                np.repeat(cohorts + self.e, size)]
+        cols = [np.tile(np.arange(size), 2 * self.N_cohorts)]
+        coupled = np.zeros((2, self.N_cohorts, size))
+        values = [coupled.reshape(-1)]
+        for row, col, value in self._linear_terms():
+            if row[0] % self.N_compartments == self.e:
+                # inside the Exposed rows, laid out above
+                coupled[1, row // self.N_compartments, col] = value
+                continue
+            rows.append(row)
+            cols.append(col)
+            values.append(value)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        order = np.lexsort((rows, cols))
+        position = np.empty(len(order), dtype=np.intp)
+        position[order] = np.arange(len(order))
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(cols, minlength=size))))
+        n_coupled = self.N_cohorts * size
+        self._sparse_layout = (
+            rows[order], indptr, np.concatenate(values)[order],
+            position[:n_coupled].reshape(self.N_cohorts, size),
+            position[n_coupled:2*n_coupled].reshape(self.N_cohorts, size))
+        return self._sparse_layout
+
+    def _d_infections(self, y, contact):
+        """Derivative of new infections in cohort a with respect to each
+        y[b,k], as an array (cohorts, cohorts, compartments)."""
+        y = y.reshape(self.N_cohorts, self.N_compartments)
+        size = y.sum(axis=1)
+        prevalence = (y[:,self.i] + y[:,self.m]) / size
+        infection_rate = self.beta * (contact @ prevalence)
+
+        # derivative of (I_b + M_b)/N_b with respect to each y[b,k]
+        d_prevalence = np.repeat(-prevalence[:,None], self.N_compartments, 1)
+        d_prevalence[:,[self.i, self.m]] += 1
+        d_prevalence /= size[:,None]
+
+        d_infections = ((self.beta * y[:,self.s])[:,None,None] *
+                        contact[:,:,None] * d_prevalence[None,:,:])
+        cohorts = np.arange(self.N_cohorts)
+        d_infections[cohorts,cohorts,self.s] += infection_rate
+        return d_infections
+
+    def _jac(self, y, contact):
+        """Evaluate the Jacobian for a fixed contact matrix."""
+        size = self.N_cohorts * self.N_compartments
+        jac = np.zeros((size, size))
+        for row, col, value in self._linear_terms():
+            jac[row, col] = value
+        d_infections = self._d_infections(y, contact).reshape(
+            self.N_cohorts, size)
+        jac[self.s::self.N_compartments] -= d_infections
+        jac[self.e::self.N_compartments] += d_infections
+        return jac
+
+    def _sparse_jac(self, y, contact):
+        """Evaluate the Jacobian for a fixed contact matrix, as CSC, without
+        forming the dense matrix."""
+        indices, indptr, data, s_entries, e_entries = self._sparse_pattern()
+        d_infections = self._d_infections(y, contact).reshape(
+            self.N_cohorts, -1)
+        data = data.copy()
+        data[s_entries] -= d_infections
+        data[e_entries] += d_infections
+        size = self.N_cohorts * self.N_compartments
+        return scipy.sparse.csc_matrix((data, indices, indptr),
+                                       shape=(size, size))
+
+    def solve(self, y0, piecewise=False, cache=None, **options):
+        """Integrate the coupled differential equations.
+
+        Arguments:
+            y0: Flattened initial state
+            piecewise: If True, integrate each epoch separately, carrying the
+                state across epoch boundaries, so that the solver never has
+                to locate a change in the contact matrix by rejecting steps.
+            cache: Optional SolutionCache to look the solution up in, and to
+                store it in after a miss
+            options: Keyword arguments passed on to the scipy ODE solver,
+                e.g. method, rtol, atol. The implicit methods in
+                IMPLICIT_METHODS are given the analytic Jacobian unless jac is
+                passed explicitly; sparse_jacobian=True makes BDF and Radau
+                use sparse LU decompositions. method='RK4' selects the
+                fixed-step integrator, with the substeps per day set by
+                step_rate (cf. substeps); it is always epoch-aware.
+
+        Returns: The days and an array (N_cohorts * N_compartments, days)
+        """
+        if cache is None:
+            t, y, _ = self._solve(y0, piecewise, **options)
+            return t, y
+        key = cache.key(self, y0, piecewise=piecewise, **options)
+        solution = cache.get(key)
+        if solution is None:
+            t, y, _ = self._solve(y0, piecewise, **options)
+            solution = cache.put(key, t, y)
+        elif self.profile is not None:
+            self.profile.cache_hits += 1
+        return solution
+
+    def instrument(self, enabled=True):
+        """Turn the collection of a Profile on or off.
+
+        Instrumentation wraps _rhs and _fetch_contact of this instance in
+        timers, and records the wall time and solver statistics of every
+        epoch. Turning it off removes the wrappers, so an uninstrumented
+        model pays only one attribute test per epoch.
+
+        Returns: A fresh Profile, or None if enabled is False.
+        """
+        for name in ['_rhs', '_fetch_contact']:
+            self.__dict__.pop(name, None)
+        self.profile = None
+        if not enabled:
+            return None
+        self.profile = Profile()
+        self._rhs = self.profile.wrap(self._rhs, 'rhs')
+        self._fetch_contact = self.profile.wrap(
+            self._fetch_contact, 'fetch_contact')
+        return self.profile
+
+    def _solve(self, y0, piecewise, sparse_jacobian=False, **options):
+        """Integrate, returning the days, states and solver statistics."""
+        t_eval = np.arange(self.epoch_end_times[-1])
+        method = options.get('method')
+        use_jac = method in IMPLICIT_METHODS and 'jac' not in options
+        sparse = sparse_jacobian and method != 'LSODA'
+        if self.profile is not None:
+            self.profile.solves += 1
+        if not (piecewise or method in FIXED_STEP_METHODS):
+            self._checkpoints = None
+            if use_jac:
+                options['jac'] = lambda t, y: self.jac(t, y, sparse)
+            tick = time.perf_counter()
+            y, _, _, stats = _integrate(
+                self.f, (0, self.epoch_end_times[-1]), y0, t_eval, **options)
+            if self.profile is not None:
+                self.profile.add_epoch(0, self.epoch_end_times[-1],
+                                       time.perf_counter() - tick, stats)
+            return t_eval, y, stats
+
+        # restart from the latest checkpoint the schedule change left intact
+        key = (np.asarray(y0, dtype=float).tobytes(), self.alpha, self.beta,
+               self.gamma, self.delta, self.kappa.tobytes(),
+               repr(sorted(options.items())))
+        y = np.empty((len(y0), len(t_eval)))
+        self.restart_time, states = 0, {0: np.array(y0, dtype=float)}
+        previous = self._checkpoints
+        if previous is not None and previous['key'] == key:
+            change = self._first_change(
+                previous['contacts'], previous['epoch_end_times'])
+            self.restart_time = max(t for t in previous['states']
+                                    if t <= change)
+            states = {t: state for t, state in previous['states'].items()
+                      if t <= self.restart_time}
+            lo = np.searchsorted(t_eval, self.restart_time)
+            y[:,:lo] = previous['y'][:,:lo]
+
+        stats = dict.fromkeys(SOLVER_STATS, 0)
+        start, y_start, h = (
+            self.restart_time, states[self.restart_time], None)
+        for end, contact in zip(self.epoch_end_times, self.contacts):
+            if end <= start:
+                continue
+            lo, hi = np.searchsorted(t_eval, [start, end])
+            tick = time.perf_counter()
+            if method in FIXED_STEP_METHODS:
+                y[:,lo:hi], y_start, epoch_stats = self._rk4(
+                    contact, (start, end), y_start, t_eval[lo:hi], **options)
+            else:
+                if use_jac:
+                    options['jac'] = self._fixed_jac(contact, sparse)
+                y[:,lo:hi], y_start, h, epoch_stats = _integrate(
+                    lambda t, y, c=contact: self._rhs(y, c), (start, end),
+                    y_start, t_eval[lo:hi],
+                    **_carry_step(options, h, end - start))
+            if self.profile is not None:
+                self.profile.add_epoch(start, end, time.perf_counter() - tick,
+                                       epoch_stats)
+            _accumulate(stats, epoch_stats)
+            states[end] = np.array(y_start)
+            start = end
+
+        self._checkpoints = {
+            'key': key, 'contacts': list(self.contacts),
+            'epoch_end_times': list(self.epoch_end_times),
+            'states': states, 'y': y.copy()}
+        return t_eval, y, stats
+
+    def _first_change(self, contacts, epoch_end_times):
+        """Return the first day on which a previous schedule differs."""
+        start = 0
+        for end in sorted(set(epoch_end_times) | set(self.epoch_end_times)):
+            old = bisect.bisect_left(epoch_end_times, end)
+            new = bisect.bisect_left(self.epoch_end_times, end)
+            if (old == len(contacts) or new == len(self.contacts) or
+                    not np.array_equal(contacts[old], self.contacts[new])):
+                return start
+            start = end
+        return start
+
+    def reschedule(self, contact_matrices, epoch_end_times):
+        """Replace the epoch schedule, keeping the state checkpoints.
+
+        A subsequent piecewise or fixed-step solve with the same initial
+        state, rates and options integrates only from the last checkpoint
+        before the first day on which the new schedule differs.
+        """
+        if len(epoch_end_times) != len(contact_matrices):
+            raise ValueError('Each contact matrix requires an epoch end time.')
+        self.contacts = contact_matrices
+        self.epoch_end_times = epoch_end_times
+
+    def substeps(self, contact, step_rate=RK4_STEP_RATE):
+        """Number of fixed RK4 substeps per day for a given contact matrix.
+
+        The step h is chosen so that h times the fastest rate in the system
+        (alpha, gamma, delta, or the largest possible force of infection,
+        beta times a row sum of the contact matrix) is at most step_rate.
+        """
+        rate = max(self.alpha, self.gamma, self.delta,
+                   self.beta * np.abs(contact).sum(axis=1).max())
+        return max(1, int(np.ceil(rate / step_rate)))
+
+    def _rk4(self, contact, t_span, y0, t_eval, method='RK4',
+             step_rate=RK4_STEP_RATE):
+        """Integrate one epoch with classical RK4 on a fixed grid.
+
+        The grid holds the whole days within t_span, each split into
+        substeps, so contact matrices change exactly at grid points. The
+        stage derivatives are written in place into one preallocated array.
+
+        Returns: An array (len(y0), len(t_eval)) of sampled states, the state
+            at the end of t_span and a dict of solver statistics.
+        """
+        start, end = t_span
+        y = np.array(y0, dtype=float)
+        out = np.empty((len(y), len(t_eval)))
+        k = np.empty((4, len(y)))
+        weights = np.array([1, 2, 2, 1]) / 6
+
+        n_sub = self.substeps(contact, step_rate)
+        grid = np.concatenate(
+            ([start], np.arange(np.floor(start) + 1, np.ceil(end)), [end]))
+        cols = np.searchsorted(t_eval, grid[:-1])
+        for t0, t1, col in zip(grid[:-1], grid[1:], cols):
+            if col < len(t_eval) and t_eval[col] == t0:
+                out[:,col] = y
+            h = (t1 - t0) / n_sub
+            for _ in range(n_sub):
+                self._rhs(y, contact, k[0])
+                self._rhs(y + h/2 * k[0], contact, k[1])
+                self._rhs(y + h/2 * k[1], contact, k[2])
+                self._rhs(y + h * k[2], contact, k[3])
+                y += h * (weights @ k)
+
+        steps = n_sub * (len(grid) - 1)
+        stats = {'nfev': 4 * steps, 'njev': 0, 'nlu': 0,
+                 'accepted_steps': steps, 'rejected_steps': 0}
+        return out, y, stats
+
+    def _fixed_jac(self, contact, sparse):
+        """Return a Jacobian callable for a fixed contact matrix."""
+        if sparse:
+            return lambda t, y: self._sparse_jac(y, contact)
+        return lambda t, y: self._jac(y, contact)
+
+    def integration_savings(self, y0, **options):
+        """Compare the cost of the piecewise and single-span integrations.
+
+        Returns: A dict with the solver statistics of each path ('global',
+            'piecewise') and the number of evaluations and steps that the
+            piecewise path saved ('saved').
+        """
+        _, _, whole = self._solve(y0, piecewise=False, **options)
+        _, _, piecewise = self._solve(y0, piecewise=True, **options)
+        saved = {
+            k: None if whole[k] is None or piecewise[k] is None
+                else whole[k] - piecewise[k] for k in SOLVER_STATS}
+        return {'global': whole, 'piecewise': piecewise, 'saved': saved}
+
+    def solve_summary(self, y0, piecewise=False, **options):
+        """Solve for summary outcomes only, without any daily output.
+
+        The peak is located by a solve_ivp event on the growth of the
+        Infected total, which is linear in y, so the root is found on the
+        solver's dense output between steps. Nothing is sampled on a daily
+        grid, and no dataframe is built.
+
+        Arguments:
+            y0: Flattened initial state
+            piecewise: If True, integrate each epoch separately, cf. solve;
+                epoch boundaries, where the growth may jump, are then also
+                candidates for the peak.
+            options: Keyword arguments passed on to scipy's solve_ivp; the
+                fixed-step methods are not supported.
+
+        Returns: A Summary.
+        """
+        method = options.get('method')
+        if method in FIXED_STEP_METHODS:
+            raise ValueError('solve_summary requires a scipy ODE solver.')
+        use_jac = method in IMPLICIT_METHODS and 'jac' not in options
+
+        # d/dt of the Infected total, as a fixed linear function of y
+        infected = np.zeros((self.N_cohorts, self.N_compartments))
+        infected[:,self.e] = self._alpha_survive
+        infected[:,self.i] = -self.gamma
+        infected = infected.ravel()
+        def growth(t, y):
+            return infected @ y
+        growth.direction = -1
+
+        y = np.array(y0, dtype=float)
+        horizon = self.epoch_end_times[-1]
+        if piecewise:
+            spans = zip([0] + list(self.epoch_end_times[:-1]),
+                        self.epoch_end_times, self.contacts)
+        else:
+            spans = [(0, horizon, None)]
+        peak, peak_day = y[self.i::self.N_compartments].sum(), 0.
+        for start, end, contact in spans:
+            if contact is None:
+                fun = self.f
+                if use_jac:
+                    options['jac'] = self.jac
+            else:
+                fun = lambda t, y, c=contact: self._rhs(y, c)
+                if use_jac:
+                    options['jac'] = self._fixed_jac(contact, False)
+            solution = scipy.integrate.solve_ivp(
+                fun, (start, end), y, events=growth, **options)
+            if solution.status == -1:
+                raise RuntimeError(solution.message)
+            y = solution.y[:,-1]
+            candidates = list(zip(solution.t_events[0],
+                                  solution.y_events[0])) + [(end, y)]
+            for t, state in candidates:
+                value = state[self.i::self.N_compartments].sum()
+                if value > peak:
+                    peak, peak_day = value, float(t)
+
+        population = np.sum(y0)
+        return Summary(
+            peak_infected=float(peak), peak_day=peak_day,
+            attack_rate=float(
+                1 - y[self.s::self.N_compartments].sum() / population),
+            cumulative_deaths=float(y[self.d::self.N_compartments].sum()))
+
+    def solve_to_dataframe(self, y0, detailed_output=False, columnar=False,
+                           dtype=None, **options):
+        """Solve and output a tidy dataframe.
+
+        With columnar=True, return a SolutionFrame over the solver's array
+        instead, optionally cast to dtype (e.g. np.float32); it builds the
+        long format only on request.
+        """
+        t, y = self.solve(y0, **options)
+        tick = time.perf_counter()
         y = y.reshape(self.N_cohorts, self.N_compartments, len(t))
+        if columnar:
+            cohorts = (AGE_COHORTS if self.N_cohorts == len(AGE_COHORTS)
+                       else list(range(self.N_cohorts)))
+            frame = SolutionFrame(t, y, self.compartments, cohorts,
+                                  str(self.epoch_end_times[:-1]), dtype)
+            if self.profile is not None:
+                self.profile.seconds['dataframe'] += time.perf_counter() - tick
+            return (frame, y) if detailed_output else frame
 
         # calculate the time series for the total population
         aggregate_nums = np.sum(y, axis=0)
@@ -160,17 +796,446 @@ class SEIRModel(object):
                           **dict(zip(self.compartments, aggregate_nums))))
         df = pd.melt(df, id_vars=['days'], var_name='Group', value_name='pop')
         df['Date(s) of intervention'] = str(self.epoch_end_times[:-1])
+        if self.profile is not None:
+            self.profile.seconds['dataframe'] += time.perf_counter() - tick
 
         if detailed_output == True:
             return df, y
         else:
             return df
 
+class SolutionFrame(object):
+    """Columnar view of a solution, backed by the solver's own array.
+
+    The states are held once, as an array (cohorts, compartments, days)
+    that is a view of the solver output unless a dtype conversion was asked
+    for. Per-compartment series are read off as views or cohort sums, and a
+    long-format dataframe, with categorical Group and Cohort columns, is
+    built only by to_frame, for the requested groups.
+
+    Attributes:
+        t: The days
+        y: Array (cohorts, compartments, days) of states
+        compartments: List of names of compartments
+        cohorts: List of names of cohorts
+        interventions: Description of the dates of intervention
+
+    External methods:
+        series: One compartment, for one cohort or summed over cohorts.
+        totals: All compartments summed over cohorts.
+        to_frame: Build a long-format dataframe.
+    """
+    def __init__(self, t, y, compartments, cohorts, interventions='',
+                 dtype=None):
+        self.t = t
+        self.y = np.asarray(y) if dtype is None else np.asarray(y, dtype)
+        self.compartments = list(compartments)
+        self.cohorts = list(cohorts)
+        self.interventions = interventions
+        self._totals = None
+
+    @property
+    def nbytes(self):
+        """Bytes held by the states and days."""
+        return self.y.nbytes + np.asarray(self.t).nbytes
+
+    def series(self, group, cohort=None):
+        """The series of one compartment, a view when cohort is given."""
+        k = self.compartments.index(group)
+        if cohort is None:
+            return self.totals()[k]
+        return self.y[self.cohorts.index(cohort), k]
+
+    def totals(self):
+        """Array (compartments, days) summed over cohorts, computed once."""
+        if self._totals is None:
+            self._totals = self.y.sum(axis=0)
+        return self._totals
+
+    def to_frame(self, groups=None, by_cohort=False):
+        """Build a long-format dataframe, as from solve_to_dataframe.
+
+        Arguments:
+            groups: Compartments to include; defaults to all of them.
+            by_cohort: If True, add a Cohort column instead of summing over
+                cohorts.
+
+        Returns: A dataframe with columns days, Group, (Cohort,) pop and
+            'Date(s) of intervention', the text columns being categorical.
+        """
+        groups = self.compartments if groups is None else list(groups)
+        idx = [self.compartments.index(g) for g in groups]
+        n_days = len(self.t)
+        if by_cohort:
+            values = self.y[:,idx].transpose(1, 0, 2).ravel()
+            n_cohorts = len(self.cohorts)
+        else:
+            values = self.totals()[idx].ravel()
+            n_cohorts = 1
+        columns = {
+            'days': np.tile(self.t, len(idx) * n_cohorts),
+            'Group': pd.Categorical.from_codes(
+                np.repeat(np.arange(len(idx)), n_cohorts * n_days), groups)}
+        if by_cohort:
+            columns['Cohort'] = pd.Categorical.from_codes(
+                np.tile(np.repeat(np.arange(n_cohorts), n_days), len(idx)),
+                self.cohorts)
+        columns['pop'] = values
+        columns['Date(s) of intervention'] = pd.Categorical.from_codes(
+            np.zeros(len(values), dtype=np.int8), [self.interventions])
+        return pd.DataFrame(columns)
+
+class SEIREnsemble(object):
+    """Class to solve many age-structured SEIR models in one integration.
+
+    Ensemble members share the cohort structure and the time horizon but may
+    each have their own contact matrices, epoch schedule, rate parameters and
+    initial state. The members are stacked into one state of shape
+    (batch, cohorts, compartments) and integrated together, so the cost of a
+    sweep is set by NumPy vector width rather than by per-solve overhead.
+
+    N.B. The adaptive step size is shared by all members and the error norm
+    is taken over the whole stacked state. Tighten rtol/atol when members
+    have very different dynamics.
+
+    Attributes:
+        contacts: Array (batch, segments, cohorts, cohorts) of effective
+            contact matrices, one per segment of the merged epoch schedule.
+        segment_end_times: Sorted array of days at which the transmission
+            rates of any member change.
+        alpha, beta, gamma, delta: Arrays of per-member rates, cf. SEIRModel
+        kappa: Array (batch, cohorts) of mortality rates
+        N_batch: Number of ensemble members
+        N_cohorts: Number of cohorts
+        compartments: List of names of compartments
+        N_compartments: Number of compartments
+        s, e, i, m, r, d: Indices of the compartments in the state
+
+    External methods:
+        from_models: Build an ensemble from a list of SEIRModel instances.
+        f: Function giving the rate of change in the stacked state.
+        solve: Integrate all members, returning (batch, time, cohort,
+            compartment) trajectories.
+    """
+    def __init__(self, contact_matrices, epoch_end_times,
+                     incubation_period=5.1, prob_of_transmission=.034,
+                     duration_of_infection=6.3, time_to_death=17.8,
+                     mortality_rates=INFECTION_FATALITY,
+                     N_cohorts=len(AGE_COHORTS)):
+        """
+        Arguments:
+            contact_matrices: Per-member lists of contact matrices, or an
+                array of shape (batch, epochs, cohorts, cohorts)
+            epoch_end_times: Per-member lists of epoch end times, or a single
+                list shared by all members
+            incubation_period, prob_of_transmission, duration_of_infection,
+                time_to_death: Scalars, or sequences with one value per member
+            mortality_rates: Per-cohort rates, or an array (batch, cohorts)
+            N_cohorts: Number of cohorts
+        """
+        self.N_batch = len(contact_matrices)
+        self.N_cohorts = N_cohorts
+        if np.ndim(epoch_end_times[0]) == 0:
+            epoch_end_times = [epoch_end_times] * self.N_batch
+        if len(epoch_end_times) != self.N_batch:
+            raise ValueError('Each member requires an epoch schedule.')
+        for contacts, end_times in zip(contact_matrices, epoch_end_times):
+            if len(end_times) != len(contacts):
+                raise ValueError(
+                    'Each contact matrix requires an epoch end time.')
+        if len(set(end_times[-1] for end_times in epoch_end_times)) > 1:
+            raise ValueError('Members must share the same time horizon.')
+
+        # merge the members' schedules so that one segment index applies to
+        # every member at any given time
+        self.segment_end_times = np.array(
+            sorted(set().union(*epoch_end_times)), dtype=float)
+        self.contacts = np.empty(
+            (self.N_batch, len(self.segment_end_times), N_cohorts, N_cohorts))
+        for n, (contacts, end_times) in enumerate(
+                zip(contact_matrices, epoch_end_times)):
+            idx = np.searchsorted(end_times, self.segment_end_times)
+            self.contacts[n] = np.asarray(contacts, dtype=float)[idx]
+
+        self.alpha = 1 / self._per_member(incubation_period)
+        self.beta = self._per_member(prob_of_transmission)
+        self.gamma = 1 / self._per_member(duration_of_infection)
+        self.delta = 1 / self._per_member(time_to_death)
+        self.kappa = np.broadcast_to(
+            np.asarray(mortality_rates, dtype=float),
+            (self.N_batch, N_cohorts)).copy()
+
+        self.compartments = COMPARTMENTS
+        self.N_compartments = len(COMPARTMENTS)
+        self.s, self.e, self.i, self.m, self.r, self.d = list(
+            range(len(COMPARTMENTS)))
+
+        # per-member rates, shaped to broadcast against (batch, cohorts)
+        self._beta = self.beta[:,None]
+        self._alpha = self.alpha[:,None]
+        self._gamma = self.gamma[:,None]
+        self._delta = self.delta[:,None]
+        self._alpha_survive = self._alpha * (1 - self.kappa)
+        self._alpha_die = self._alpha * self.kappa
+
+    @classmethod
+    def from_models(cls, models):
+        """Build an ensemble from a list of SEIRModel instances."""
+        ensemble = cls(
+            [m.contacts for m in models], [m.epoch_end_times for m in models],
+            incubation_period=[1/m.alpha for m in models],
+            prob_of_transmission=[m.beta for m in models],
+            duration_of_infection=[1/m.gamma for m in models],
+            time_to_death=[1/m.delta for m in models],
+            mortality_rates=[m.kappa for m in models],
+            N_cohorts=models[0].N_cohorts)
+        return ensemble
+
+    def _per_member(self, value):
+        """Broadcast a scalar or per-member parameter to shape (batch,)."""
+        return np.broadcast_to(
+            np.asarray(value, dtype=float), (self.N_batch,)).copy()
+
+    def _fetch_contact(self, t):
+        """Fetch the (batch, cohorts, cohorts) contact matrices at time t."""
+        k = np.searchsorted(self.segment_end_times, t)
+        return self.contacts[:, min(k, len(self.segment_end_times) - 1)]
+
+    def f(self, t, y):
+        """Function giving the rate of change in the stacked state y(t)."""
+        return self._rhs(y, self._fetch_contact(t))
+
+    def _rhs(self, y, contacts):
+        """Evaluate dy/dt for fixed (batch, cohorts, cohorts) contacts."""
+        y = y.reshape(self.N_batch, self.N_cohorts, self.N_compartments)
+        dy = np.empty_like(y)
+        exposed, infected, severe = y[...,self.e], y[...,self.i], y[...,self.m]
+
+        prevalence = self._mix((infected + severe) / y.sum(axis=2))
+        infection_rate = self._beta * (
+            contacts @ prevalence[...,None])[...,0]
+        new_infections = y[...,self.s] * infection_rate
+        dy[...,self.s] = -new_infections
+        dy[...,self.e] = new_infections - self._alpha * exposed
+        dy[...,self.i] = (self._alpha_survive * exposed -
+                          self._gamma * infected)
+        dy[...,self.m] = self._alpha_die * exposed - self._delta * severe
+        dy[...,self.r] = self._gamma * infected
+        dy[...,self.d] = self._delta * severe
+        return dy.reshape(-1)
+
+    def _mix(self, prevalence):
+        """Prevalence each member is exposed to; members are independent."""
+        return prevalence
+
+    def solve(self, y0, piecewise=False, t_start=0, **options):
+        """Integrate the coupled differential equations for every member.
+
+        Arguments:
+            y0: Initial states, shape (batch, cohorts, compartments), or a
+                single (cohorts, compartments) state shared by all members
+            piecewise: If True, integrate each segment of the merged epoch
+                schedule separately, cf. SEIRModel.solve
+            t_start: Day on which the states y0 hold, e.g. a checkpoint
+                shared by all members
+            options: Keyword arguments passed on to the scipy ODE solver
+
+        Returns: The days from t_start and an array of shape
+            (batch, time, cohorts, compartments)
+        """
+        shape = (self.N_batch, self.N_cohorts, self.N_compartments)
+        y0 = np.broadcast_to(
+            np.asarray(y0, dtype=float).reshape((-1,) + shape[1:]), shape)
+        horizon = self.segment_end_times[-1]
+        t_eval = np.arange(int(np.ceil(t_start)), horizon)
+        if piecewise:
+            y = integrate_epochs(
+                lambda k, t, y: self._rhs(y, self.contacts[:,k]),
+                self.segment_end_times, y0.ravel(), t_eval, t_start,
+                **options)
+        else:
+            y, _, _, _ = _integrate(
+                self.f, (t_start, horizon), y0.ravel(), t_eval, **options)
+        y = y.reshape(shape + (len(t_eval),))
+        return t_eval, np.ascontiguousarray(np.moveaxis(y, -1, 1))
+
+class SEIRMetapopulation(SEIREnsemble):
+    """Class to solve regional SEIR models coupled by mobility.
+
+    Each region is a member of the underlying ensemble, with its own
+    contact matrices, epoch schedule (e.g. from model_input) and rates.
+    Residents of region a spend a fraction M[a, b] of their contacts in
+    region b, so the prevalence they meet is W @ prevalence, with the
+    row-stochastic mixing matrix W = M + diag(1 - sum_b M[a, b]). W is kept
+    sparse, so the coupling costs O(links * cohorts) per evaluation rather
+    than O(regions^2).
+
+    Attributes:
+        mixing: Sparse CSR matrix W (regions, regions)
+        N_regions: Number of regions
+        (the remaining attributes are those of SEIREnsemble)
+
+    External methods:
+        f: Function giving the rate of change in the stacked state.
+        solve: Integrate all regions, returning (region, time, cohort,
+            compartment) trajectories.
+    """
+    def __init__(self, contact_matrices, epoch_end_times, mobility,
+                     **kwargs):
+        """
+        Arguments:
+            contact_matrices, epoch_end_times: Per-region schedules, as for
+                SEIREnsemble
+            mobility: Matrix M (regions, regions), dense or scipy.sparse, of
+                the fraction of contacts the residents of each row region
+                make in each column region. Rows must sum to at most one;
+                the diagonal is ignored.
+            kwargs: Rate parameters, scalars or per region, cf. SEIREnsemble
+        """
+        super().__init__(contact_matrices, epoch_end_times, **kwargs)
+        self.N_regions = self.N_batch
+        mobility = scipy.sparse.csr_matrix(mobility, dtype=float)
+        if mobility.shape != (self.N_regions, self.N_regions):
+            raise ValueError(
+                'Mobility requires one row and column per region.')
+        mobility.setdiag(0)
+        mobility.eliminate_zeros()
+        away = np.asarray(mobility.sum(axis=1)).ravel()
+        if np.any(mobility.data < 0) or np.any(away > 1 + 1e-12):
+            raise ValueError(
+                'Mobility fractions must be non-negative, with rows summing '
+                'to at most one.')
+        self.mixing = (mobility + scipy.sparse.diags(1 - away)).tocsr()
+
+    def _mix(self, prevalence):
+        """Prevalence met by the residents of each region."""
+        return self.mixing @ prevalence
+
+class SolutionCache(object):
+    """Content-addressed cache of model solutions, with LRU eviction.
+
+    Solutions are keyed by a hash of everything that determines them: the
+    contact matrices, epoch end times, rate parameters, initial state and
+    solver options. An optional directory adds an on-disk tier of .npz files,
+    which survives restarts and can be shared between processes. Cached
+    arrays are returned read-only.
+
+    Attributes:
+        maxsize: Maximum number of solutions held in memory
+        directory: Directory for the on-disk tier, or None
+        hits: Number of lookups served from memory
+        disk_hits: Number of lookups served from disk
+        misses: Number of lookups that found nothing
+
+    External methods:
+        key: Hash a model, initial state and solver options.
+        get: Look up a solution by key.
+        put: Store a solution under a key.
+        stats: Report hit/miss statistics.
+        clear: Empty the in-memory tier and reset the statistics.
+    """
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self._solutions = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    @staticmethod
+    def key(seir, y0, **options):
+        """Hash a model, initial state and solver options."""
+        digest = hashlib.sha256()
+        for array in [seir.contacts, seir.epoch_end_times, seir.kappa, y0,
+                      [seir.alpha, seir.beta, seir.gamma, seir.delta]]:
+            array = np.ascontiguousarray(array, dtype=float)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        digest.update(repr(sorted(options.items())).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Look up a solution by key, returning (t, y) or None."""
+        with self._lock:
+            if key in self._solutions:
+                self._solutions.move_to_end(key)
+                self.hits += 1
+                return self._solutions[key]
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            with np.load(path) as npz:
+                solution = self._store(key, (npz['t'], npz['y']))
+            with self._lock:
+                self.disk_hits += 1
+            return solution
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, t, y):
+        """Store a solution under a key, in memory and on disk."""
+        solution = self._store(key, (t, y))
+        path = self._path(key)
+        if path is not None and not os.path.exists(path):
+            # write to a file of its own, then rename, so readers never see
+            # a partial file even when sessions store the same key at once
+            fd, tmp = tempfile.mkstemp('.tmp.npz', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, t=t, y=y)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        return solution
+
+    def stats(self):
+        """Report hit/miss statistics and the in-memory size."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'size': len(self._solutions),
+                    'hit_rate': ((self.hits + self.disk_hits) / lookups
+                                 if lookups else 0.0)}
+
+    def clear(self):
+        """Empty the in-memory tier and reset the statistics."""
+        with self._lock:
+            self._solutions.clear()
+            self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def _store(self, key, solution):
+        """Add a read-only solution to the in-memory tier, evicting LRU."""
+        solution = tuple(np.array(a) for a in solution)
+        for a in solution:
+            a.flags.writeable = False
+        with self._lock:
+            self._solutions[key] = solution
+            self._solutions.move_to_end(key)
+            while len(self._solutions) > self.maxsize:
+                self._solutions.popitem(last=False)
+        return solution
+
+    def _path(self, key):
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, key + '.npz')
+
+# Process-wide cache, shared by all app sessions
+SOLUTION_CACHE = SolutionCache()
+
 def model_input(contact_matrix, day_ranges, selected_npis, total_days,
-                npi_impacts=NPI_IMPACTS):
+                npi_impacts=NPI_IMPACTS, merge=True):
     """
     Function to enumerate conact matrices and their epochs.
 
+    An intervention applies to an epoch if their day ranges overlap by more
+    than one day. Since every range endpoint delimits an epoch, each
+    intervention covers a contiguous run of epochs, found by bisection, and
+    the number of times each intervention is active in each epoch follows
+    from a cumulative sum over the run boundaries.
+
     Arguments:
         contact_matrix: Basic contact matrix, without interventions
         day_ranges: List of day range tuples denoting the period
@@ -179,36 +1244,75 @@ def model_input(contact_matrix, day_ranges, selected_npis, total_days,
         total_days: Total number of days to run model
         npi_impacts: Dict of interventions of form {name: impact}, 
             cf. NPI_IMPACTS above.
+        merge: If True, merge adjacent epochs whose effective contact
+            matrices are equal.
         
     Returns: A list of effective contact matrices and a list of epoch end times
     """
-    def _intersects(day_range, epoch_tuple):
-        cs = set(range(*day_range))
-        es = set(range(*epoch_tuple))
-        if len(cs.intersection(es)) > 1:
-            return True
-        else:
-            return False
+    names, factors, counts, epoch_ends = intervention_factors(
+        day_ranges, selected_npis, total_days, np.shape(contact_matrix),
+        npi_impacts)
+    contacts = contact_matrix * np.prod(
+        factors ** counts.T[:,:,None,None], axis=1)
+
+    if merge and len(contacts) > 1:
+        changes = np.any(contacts[1:] != contacts[:-1], axis=(1, 2))
+        keep = np.append(changes, True)
+        contacts = contacts[keep]
+        epoch_ends = [end for end, k in zip(epoch_ends, keep) if k]
+    return [list(contacts), epoch_ends]
+
+def intervention_factor(impact, shape):
+    """The factor by which an intervention multiplies a contact matrix: chi
+    overall and xi at its indices, cf. NPI_IMPACTS."""
+    factor = np.full(shape, float(impact.get('chi', 1)))
+    for idx_pair in impact.get('indices', []):
+        factor[idx_pair] *= impact.get('xi', 1)
+    return factor
+
+def intervention_factors(day_ranges, selected_npis, total_days, shape,
+                         npi_impacts=NPI_IMPACTS):
+    """Factors of the interventions in a schedule and their activity.
 
-    def _apply(npi, npi_impacts, contact_matrix):
-        impact = npi_impacts.get(npi, {})
-        contact_matrix *= impact.get('chi', 1)
-        for idx_pair in impact.get('indices', []):
-            contact_matrix[idx_pair] *= impact.get('xi', 1)
-        return contact_matrix
+    The effective contact matrix of epoch k is the basic one times the
+    product of factors ** counts[:,k], cf. model_input.
 
+    Arguments:
+        day_ranges, selected_npis, total_days, npi_impacts: cf. model_input
+        shape: Shape of the contact matrix
+
+    Returns: The names of the interventions that have an impact, an array
+        (names,) + shape of their factors, an integer array (names, epochs)
+        of the number of their ranges active in each epoch, and the list of
+        epoch end times, before any merging.
+    """
     epoch_tuples = _partition(day_ranges, total_days)
-    contact_matrices = []
+    names, counts = _active_counts(day_ranges, selected_npis, epoch_tuples,
+                                   npi_impacts)
+    factors = np.array([intervention_factor(npi_impacts[npi], shape)
+                        for npi in names]).reshape((len(names),) + shape)
+    return names, factors, counts, [e[1] for e in epoch_tuples]
 
-    for epoch in epoch_tuples:
-        c_eff = contact_matrix.copy()
-        for day_range, npi in zip(day_ranges, selected_npis):
-            if _intersects(day_range, epoch):
-                c_eff = _apply(npi, npi_impacts, c_eff)
-        contact_matrices.append(c_eff)
+def _active_counts(day_ranges, selected_npis, epoch_tuples,
+                   npi_impacts=NPI_IMPACTS):
+    """Count how many times each intervention is active in each epoch.
+
+    Returns: The names of the interventions that have an impact, and an
+        integer array of shape (names, epochs).
+    """
+    names = sorted(set(selected_npis) & set(npi_impacts))
+    delims = [e[0] for e in epoch_tuples] + [e[1] for e in epoch_tuples[-1:]]
+    counts = np.zeros((len(names), len(delims)), dtype=int)
+    for (start, end), npi in zip(day_ranges, selected_npis):
+        if npi in npi_impacts and start < end:
+            row = names.index(npi)
+            counts[row, bisect.bisect_left(delims, start)] += 1
+            counts[row, bisect.bisect_left(delims, end)] -= 1
+    counts = np.cumsum(counts, axis=1)[:,:-1]
 
-    epoch_ends = [e[1] for e in epoch_tuples]
-    return [contact_matrices, epoch_ends]
+    # epochs of a single day never overlap a range by more than one day
+    counts[:,np.diff(delims) <= 1] = 0
+    return names, counts
 
 def _partition(day_ranges, total_days):
     """Partition day_ranges into unique, non-overlapping epochs."""
@@ -0,0 +1,271 @@
+"""Tiled, memory-mapped copies of the app's rasters, with overviews.
+
+Each GeoTIFF is converted once, a strip of tiles at a time, into float32
+.npy files laid out as (tile rows, tile columns, tile, tile), so a tile is
+contiguous on disk. Overviews halve the resolution level by level down to
+a single tile, averaging each 2 x 2 block of valid pixels. The minimum,
+maximum and a histogram of the full-resolution values are stored with
+them. Conversions are published and kept current as in datastore.py.
+
+Rendering picks the coarsest level that still fills the display width,
+reads only the tiles in view and colors them with a lookup table, so its
+cost depends on the display, not on the raster. Sources are read a window
+of rows at a time with rasterio, so conversion memory is bounded by a strip
+of tiles; without rasterio, PIL decodes the whole image at conversion,
+which only suits small rasters.
+
+Convert ahead of time (e.g. in the Docker build) with:
+
+    python raster.py
+
+Example:
+
+    nitrogen = raster.load('nitrogen')
+    rgba = nitrogen.render((400, 2000), width=800)
+
+"""
+
+import os
+
+import numpy as np
+
+import datastore
+
+DIRECTORY = 'data/tiles'
+TILE = 256
+BINS = 256
+
+# Source GeoTIFF and nodata value of each raster (None if every pixel is
+# valid)
+RASTERS = {
+    'nitrogen': ('data/nitrogen.tif', None),
+    'soilorganiccarbonstock': ('data/soilorganiccarbonstock.tif', None)
+}
+
+def _strips(source, rows):
+    """The raster's shape and a generator of its strips of rows.
+
+    Uses windowed reads with rasterio (in requirements.txt), falling back
+    to decoding the whole image with PIL.
+    """
+    try:
+        import rasterio
+        import rasterio.windows
+    except ImportError:
+        from PIL import Image
+        image = np.asarray(Image.open(source))
+        height, width = image.shape[:2]
+        strips = (image[i:i+rows] for i in range(0, height, rows))
+        return (height, width), strips
+
+    dataset = rasterio.open(source)
+    height, width = dataset.height, dataset.width
+
+    def strips():
+        with dataset:
+            for i in range(0, height, rows):
+                yield dataset.read(1, window=rasterio.windows.Window(
+                    0, i, width, min(rows, height - i)))
+    return (height, width), strips()
+
+def _tile_row(strip, n_tiles, tile):
+    """Pad a strip of up to tile rows with NaN and cut it into tiles."""
+    padded = np.full((tile, n_tiles * tile), np.nan, dtype=np.float32)
+    padded[:strip.shape[0], :strip.shape[1]] = strip
+    return padded.reshape(tile, n_tiles, tile).transpose(1, 0, 2)
+
+def _overview(level, path, tile):
+    """Write the next overview of a level, a row of output tiles at a
+    time, averaging the valid pixels of each 2 x 2 block."""
+    n_rows, n_cols = level.shape[:2]
+    shape = ((n_rows + 1) // 2, (n_cols + 1) // 2, tile, tile)
+    overview = np.lib.format.open_memmap(path, 'w+', np.float32, shape)
+    for j in range(shape[0]):
+        rows = np.asarray(level[2*j:2*j+2])
+        strip = rows.transpose(0, 2, 1, 3).reshape(
+            rows.shape[0] * tile, n_cols * tile)
+        blocks = np.full((2 * tile, 2 * shape[1] * tile), np.nan,
+                         dtype=np.float32)
+        blocks[:strip.shape[0], :strip.shape[1]] = strip
+        blocks = blocks.reshape(tile, 2, shape[1] * tile, 2)
+        valid = np.isfinite(blocks)
+        with np.errstate(invalid='ignore'):
+            mean = (np.where(valid, blocks, 0).sum(axis=(1, 3)) /
+                    valid.sum(axis=(1, 3)))
+        overview[j] = _tile_row(mean, shape[1], tile)
+    overview.flush()
+    return overview
+
+def convert(name, directory=DIRECTORY, tile=TILE):
+    """Convert a raster from its GeoTIFF to tiled .npy levels."""
+    source, nodata = RASTERS[name]
+    folder = os.path.join(directory, name)
+    os.makedirs(folder, exist_ok=True)
+    (height, width), strips = _strips(source, tile)
+    shape = (-(-height // tile), -(-width // tile), tile, tile)
+
+    paths = [os.path.join(folder, 'level0.npy')]
+    level = np.lib.format.open_memmap(
+        datastore.temporary(paths[0]), 'w+', np.float32, shape)
+    low, high = np.inf, -np.inf
+    for j, strip in enumerate(strips):
+        strip = strip.astype(np.float32)
+        if nodata is not None:
+            strip[strip == nodata] = np.nan
+        if np.isfinite(strip).any():
+            low = min(low, float(np.nanmin(strip)))
+            high = max(high, float(np.nanmax(strip)))
+        level[j] = _tile_row(strip, shape[1], tile)
+    level.flush()
+
+    counts = np.zeros(BINS, dtype=np.int64)
+    for row in level:
+        values = row[np.isfinite(row)]
+        counts += np.histogram(values, BINS, (low, high))[0]
+
+    levels = [level]
+    while levels[-1].shape[:2] != (1, 1):
+        paths.append(os.path.join(folder, 'level%d.npy' % len(levels)))
+        levels.append(_overview(levels[-1], datastore.temporary(paths[-1]),
+                                tile))
+    datastore.publish(*paths)
+    datastore.write_meta(
+        folder, source, shape=[height, width], tile=tile,
+        levels=len(levels), nodata=nodata, min=low, max=high,
+        histogram=counts.tolist(),
+        bin_edges=np.linspace(low, high, BINS + 1).tolist())
+
+def is_current(name, directory=DIRECTORY, tile=TILE):
+    """Whether the tiled copy exists and is as new as its GeoTIFF."""
+    source, nodata = RASTERS[name]
+    return datastore.is_fresh(os.path.join(directory, name), source,
+                              tile=tile, nodata=nodata)
+
+def load(name, directory=DIRECTORY, tile=TILE):
+    """Load a raster's tiled copy, converting it first if need be."""
+    if not is_current(name, directory, tile):
+        convert(name, directory, tile)
+    return TiledRaster(os.path.join(directory, name))
+
+def colormap_lut(cmap='twilight_shifted', n=256):
+    """An (n, 4) uint8 RGBA lookup table of a matplotlib colormap."""
+    import matplotlib.pyplot as plt
+    return (plt.get_cmap(cmap)(np.linspace(0, 1, n)) * 255).round().astype(
+        np.uint8)
+
+def colorize(values, window, lut):
+    """Color values in a window by a lookup table; others are transparent.
+
+    Arguments:
+        values: Array of values, NaN where there is no data
+        window: (low, high) values at the two ends of the colormap
+        lut: (n, 4) uint8 RGBA lookup table, cf. colormap_lut
+
+    Returns: A uint8 array of values.shape + (4,).
+    """
+    low, high = window
+    with np.errstate(invalid='ignore'):
+        inside = (values >= low) & (values <= high)
+        scale = (len(lut) - 1) / max(high - low, np.finfo(float).tiny)
+        index = np.where(inside, (values - low) * scale + .5, 0)
+    rgba = lut[index.astype(np.intp)]
+    rgba[~inside, 3] = 0
+    return rgba
+
+class TiledRaster(object):
+    """A converted raster: tiled levels, memory-mapped, and statistics.
+
+    Attributes:
+        path: Directory holding meta.json and level<k>.npy
+        meta: Dict of the shape, tile size, statistics etc., cf. convert
+        shape: (height, width) of the full-resolution raster
+        levels: Memory-mapped float32 arrays (tile rows, tile columns,
+            tile, tile), from full resolution down to a single tile
+        min, max: Extremes of the valid full-resolution values
+
+    External methods:
+        histogram: Counts and bin edges of the full-resolution values.
+        level_for: The coarsest level at least a given width.
+        read: Values of a window of a level, from the tiles it covers.
+        render: RGBA image of a value window, at a display width.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = datastore.read_meta(path)
+        self.shape = tuple(self.meta['shape'])
+        self.levels = [
+            np.load(os.path.join(path, 'level%d.npy' % k), mmap_mode='r')
+            for k in range(self.meta['levels'])]
+        self.min, self.max = self.meta['min'], self.meta['max']
+
+    def histogram(self):
+        """Counts and bin edges of the full-resolution values."""
+        return (np.array(self.meta['histogram']),
+                np.array(self.meta['bin_edges']))
+
+    def _level_shape(self, level):
+        return tuple(-(-n // 2 ** level) for n in self.shape)
+
+    def level_for(self, width, view=None):
+        """The coarsest level with at least width pixels across a view.
+
+        Arguments:
+            width: Display width in pixels
+            view: Width of the view in full-resolution pixels; defaults to
+                the whole raster
+        """
+        view = self.shape[1] if view is None else view
+        for level in reversed(range(len(self.levels))):
+            if -(-view // 2 ** level) >= width:
+                return level
+        return 0
+
+    def read(self, level=0, rows=None, cols=None):
+        """Values of a window of a level, reading only the tiles it covers.
+
+        Arguments:
+            level: Level index, 0 for full resolution
+            rows, cols: (start, stop) pixel ranges in the level; default to
+                the whole level
+
+        Returns: A float32 array, NaN where there is no data.
+        """
+        tile = self.meta['tile']
+        height, width = self._level_shape(level)
+        r0, r1 = (0, height) if rows is None else np.clip(rows, 0, height)
+        c0, c1 = (0, width) if cols is None else np.clip(cols, 0, width)
+        if r1 <= r0 or c1 <= c0:
+            return np.empty((0, 0), dtype=np.float32)
+        tiles = self.levels[level][r0 // tile:-(-r1 // tile),
+                                   c0 // tile:-(-c1 // tile)]
+        values = tiles.transpose(0, 2, 1, 3).reshape(
+            tiles.shape[0] * tile, tiles.shape[1] * tile)
+        r, c = r0 // tile * tile, c0 // tile * tile
+        return values[r0-r:r1-r, c0-c:c1-c]
+
+    def render(self, window, width=1024, cmap='twilight_shifted',
+               rows=None, cols=None):
+        """RGBA image of the values in a window, at a display width.
+
+        Arguments:
+            window: (low, high) values to show, across the colormap
+            width: Display width in pixels; the coarsest level with at
+                least this many pixels across the view is read
+            cmap: Matplotlib colormap name
+            rows, cols: (start, stop) full-resolution pixel ranges in view;
+                default to the whole raster
+
+        Returns: A uint8 array (rows, columns, 4).
+        """
+        view = (None if cols is None else
+                int(np.diff(np.clip(cols, 0, self.shape[1]))[0]))
+        level = self.level_for(width, view)
+        scale = 2 ** level
+        rows, cols = [None if r is None else (r[0] // scale, -(-r[1] // scale))
+                      for r in (rows, cols)]
+        return colorize(self.read(level, rows, cols), window,
+                        colormap_lut(cmap))
+
+if __name__ == '__main__':
+    for name in RASTERS:
+        convert(name)
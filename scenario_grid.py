@@ -0,0 +1,272 @@
+"""Precomputed grid of intervention schedules, for instant lookups.
+
+The app's sliders choose one window of days per intervention. An offline
+build solves every schedule whose window ends lie on a coarse grid of days,
+in parallel ensemble chunks, and stores the daily trajectories summed over
+cohorts in memory-mapped .npy files, quantized to 16 bits of the
+population. Any schedule is then answered by multilinear interpolation
+between the grid schedules around it, reading 4 corners per intervention.
+
+A schedule whose windows all end on grid days is a single cell, so its
+lookup is exact up to the quantization. Between cells, interpolation is
+only a rough preview: at the default 60-day step it can be off by half of
+the peak, since an intervention's effect is far from linear in its window.
+The app therefore takes a lookup as its answer only for a grid cell; for
+any other schedule it draws the lookup as a preview and solves live. Cells
+not yet solved are misses: lookup returns None and fill_async solves the
+missing cells on a background thread, writing them into the grid, so the
+caller never waits for a fill.
+
+Build (or resume building) the grid read by app.py, as the Docker build
+does, with:
+
+    python scenario_grid.py data/scenario_grid --step 60
+
+Example:
+
+    grid = scenario_grid.ScenarioGrid('data/scenario_grid')
+    infected = grid.lookup({'School closure': (30, 70), ...})
+
+"""
+
+import concurrent.futures
+import json
+import os
+import threading
+
+import numpy as np
+
+import model
+import uncertainty
+
+# The interventions with sliders in app.py, and its fixed shelter in place
+APP_NPIS = ['School closure', 'Cancel mass gatherings',
+            'Shielding the elderly', 'Quarantine and tracing']
+
+class ScenarioGrid(object):
+    """Memory-mapped trajectories for a grid of intervention windows.
+
+    Each intervention's window (start, end) is indexed by a pair of grid
+    days with start <= end; windows with start > end are empty, like
+    (end, end). The trajectory array has one axis per intervention, over
+    these pairs, followed by the days and the stored compartments.
+
+    Attributes:
+        path: Directory holding meta.json, trajectories.npy and filled.npy
+        meta: Dict of the grid definition, cf. create
+        days: The grid days of each window end
+        pairs: Array (pairs, 2) of the (start, end) grid windows
+        trajectories: Memory-mapped uint16 array, in units of meta['scale']
+        filled: Memory-mapped boolean array of the solved cells
+
+    External methods:
+        create: Lay out an empty grid on disk.
+        build: Solve every cell not yet filled.
+        fill: Solve the given cells.
+        fill_async: Solve the cells around a schedule on a background thread.
+        lookup: Interpolate the trajectories of a schedule.
+        on_grid: Whether a schedule is a grid cell.
+    """
+    def __init__(self, path, mode='r+'):
+        """
+        Arguments:
+            path: Directory of a grid made by create
+            mode: 'r+' to allow filling, or 'r' for read-only lookups
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.days = np.array(self.meta['days'])
+        k = len(self.days)
+        self.pairs = np.array([(a, b) for a in range(k) for b in range(a, k)])
+        self._pair_index = -np.ones((k, k), dtype=int)
+        self._pair_index[self.pairs[:,0], self.pairs[:,1]] = np.arange(
+            len(self.pairs))
+        self.trajectories = np.load(
+            os.path.join(path, 'trajectories.npy'), mmap_mode=mode)
+        self.filled = np.load(os.path.join(path, 'filled.npy'), mmap_mode=mode)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+
+    @classmethod
+    def create(cls, path, npis=APP_NPIS, step=60, total_days=300,
+               region='Americas', initial_infected=.001, population=1e6,
+               day_ranges=((20, 20),), selected_npis=('Shelter in place',),
+               groups=('Infected',)):
+        """Lay out an empty grid on disk.
+
+        Arguments:
+            path: Directory to create
+            npis: Interventions with a window each
+            step: Spacing of the grid days, from 0 to total_days
+            total_days, region, initial_infected, population: cf.
+                uncertainty.uncertainty
+            day_ranges, selected_npis: Fixed interventions
+            groups: Compartments to store, summed over cohorts
+
+        Returns: The grid, opened for filling.
+        """
+        days = sorted(set(range(0, total_days, step)) | {total_days})
+        n_pairs = len(days) * (len(days) + 1) // 2
+        meta = {'npis': list(npis), 'days': days, 'step': step,
+                'total_days': total_days, 'region': region,
+                'initial_infected': initial_infected, 'population': population,
+                'day_ranges': [list(r) for r in day_ranges],
+                'selected_npis': list(selected_npis), 'groups': list(groups),
+                'scale': population / np.iinfo(np.uint16).max}
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        shape = (n_pairs,) * len(npis)
+        np.lib.format.open_memmap(
+            os.path.join(path, 'trajectories.npy'), 'w+', np.uint16,
+            shape + (total_days, len(groups)))
+        np.lib.format.open_memmap(
+            os.path.join(path, 'filled.npy'), 'w+', bool, shape)
+        return cls(path)
+
+    def _scenario(self):
+        """The fixed inputs, cf. uncertainty.make_scenario."""
+        return uncertainty.make_scenario(*[self.meta[k] for k in [
+            'day_ranges', 'selected_npis', 'total_days', 'region',
+            'initial_infected', 'population']])
+
+    def build(self, chunk_size=64, processes=None):
+        """Solve every cell not yet filled, in parallel ensemble chunks."""
+        self.fill(np.argwhere(~np.asarray(self.filled)), chunk_size,
+                  processes)
+
+    def fill(self, cells, chunk_size=64, processes=None):
+        """Solve the given cells and write them into the grid.
+
+        Arguments:
+            cells: Integer array (cells, interventions) of pair indices
+        """
+        cells = np.asarray(cells).reshape(-1, len(self.meta['npis']))
+        windows = self.days[self.pairs[cells]]
+        chunks = ((self._scenario(), self.meta, cells[i:i+chunk_size],
+                   windows[i:i+chunk_size])
+                  for i in range(0, len(cells), chunk_size))
+        for chunk_cells, values in uncertainty.map_chunks(
+                _solve_cells, chunks, processes):
+            idx = tuple(chunk_cells.T)
+            with self._lock:
+                self.trajectories[idx] = values
+                self.filled[idx] = True
+        self._flush()
+
+    def _flush(self):
+        """Write the memory maps through to disk, if opened for writing."""
+        for array in [self.trajectories, self.filled]:
+            if isinstance(array, np.memmap) and array.mode != 'r':
+                array.flush()
+
+    def _corners(self, intervals):
+        """Cells and weights of the multilinear interpolation.
+
+        Arguments:
+            intervals: Dict of {intervention: (start, end)} for every
+                intervention of the grid
+
+        Returns: An integer array (corners, interventions) of cells and an
+            array (corners,) of weights.
+        """
+        axes = []
+        for npi in self.meta['npis']:
+            ends = []
+            for day in np.clip(intervals[npi], 0, self.days[-1]):
+                k = min(np.searchsorted(self.days, day, 'right') - 1,
+                        len(self.days) - 2)
+                w = (day - self.days[k]) / (self.days[k+1] - self.days[k])
+                ends.append([(k, 1 - w), (k + 1, w)])
+            options = []
+            for a, wa in ends[0]:
+                for b, wb in ends[1]:
+                    if wa * wb > 0:
+                        # an empty window has no effect, wherever it lies
+                        options.append((self._pair_index[min(a, b), b],
+                                        wa * wb))
+            axes.append(options)
+        grids = np.meshgrid(*[np.arange(len(a)) for a in axes],
+                            indexing='ij')
+        picks = np.stack([g.ravel() for g in grids], axis=1)
+        cells = np.array([[axes[j][p][0] for j, p in enumerate(row)]
+                          for row in picks])
+        weights = np.prod([[axes[j][p][1] for j, p in enumerate(row)]
+                           for row in picks], axis=1)
+        return cells, weights
+
+    def lookup(self, intervals):
+        """Interpolate the trajectories of a schedule.
+
+        Arguments:
+            intervals: Dict of {intervention: (start, end)} for every
+                intervention of the grid
+
+        Returns: An array (days, groups) of population counts, or None if a
+            cell it needs has not been solved.
+        """
+        cells, weights = self._corners(intervals)
+        idx = tuple(cells.T)
+        if not np.all(self.filled[idx]):
+            return None
+        values = self.trajectories[idx].astype(float)
+        return np.tensordot(weights, values, 1) * self.meta['scale']
+
+    def on_grid(self, intervals):
+        """Whether a schedule is a grid cell, so lookup needs no blending."""
+        return len(self._corners(intervals)[1]) == 1
+
+    def fill_async(self, intervals):
+        """Solve the missing cells around a schedule on a background thread.
+
+        Cells already filled or queued are skipped, so repeated misses on
+        the same schedule do not pile up work.
+
+        Returns: A concurrent.futures.Future, or None if nothing is missing.
+        """
+        cells, _ = self._corners(intervals)
+        with self._lock:
+            missing = [tuple(c) for c in cells
+                       if not self.filled[tuple(c)] and
+                       tuple(c) not in self._pending]
+            if not missing:
+                return None
+            self._pending.update(missing)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(1)
+
+        def work():
+            try:
+                self.fill(np.array(missing), processes=1)
+            finally:
+                with self._lock:
+                    self._pending.difference_update(missing)
+        return self._executor.submit(work)
+
+def _solve_cells(scenario, meta, cells, windows):
+    ensemble = uncertainty.schedule_ensemble(
+        scenario, windows, [meta['npis']] * len(windows))
+    y0 = uncertainty.initial_state(scenario['region'],
+                                   scenario['initial_infected'],
+                                   scenario['population'])
+    _, y = ensemble.solve(y0, piecewise=True, rtol=1e-6)
+    idx = [model.COMPARTMENTS.index(g) for g in meta['groups']]
+    values = np.rint(y.sum(axis=2)[...,idx] / meta['scale'])
+    return cells, np.clip(values, 0, np.iinfo(np.uint16).max).astype(
+        np.uint16)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build the scenario grid read by app.py.')
+    parser.add_argument('path', nargs='?', default='data/scenario_grid')
+    parser.add_argument('--step', type=int, default=60)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+    if os.path.exists(os.path.join(args.path, 'meta.json')):
+        grid = ScenarioGrid(args.path)
+    else:
+        grid = ScenarioGrid.create(args.path, step=args.step)
+    grid.build(processes=args.processes)
@@ -0,0 +1,216 @@
+"""Search intervention schedules under a budget of intervention days.
+
+Each candidate schedule gives every budgeted intervention one window of
+days, no longer than its budget. Candidates are sorted by their earliest
+start and solved in chunks, each chunk as one model.SEIREnsemble
+integration across a process pool. Until its earliest start a chunk follows
+the baseline, the fixed interventions alone, so the chunk is integrated only
+from that day on, starting from the cached baseline trajectory. The same
+trajectory prunes candidates whose baseline peak already breaks the capacity
+line. An evolutionary search mutates the current Pareto front of deaths
+against intervention days for a number of generations.
+
+Example:
+
+    front = scheduling.optimize_schedule(
+        {'School closure': 60, 'Shelter in place': 30}, 300,
+        capacity=50000)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import model
+import uncertainty
+
+def baseline(scenario):
+    """Solve the scenario with only its fixed interventions.
+
+    Returns: The days and an array (days, cohorts, compartments) of states.
+    """
+    contacts, epoch_end_times = model.model_input(
+        model.CONTACT_MATRICES_0[scenario['region']], scenario['day_ranges'],
+        scenario['selected_npis'], scenario['total_days'])
+    seir = model.SEIRModel(contacts, epoch_end_times)
+    y0 = uncertainty.initial_state(scenario['region'],
+                                   scenario['initial_infected'],
+                                   scenario['population'])
+    t, y = seir.solve(y0.flatten(), method='RK4')
+    return t, y.T.reshape((len(t),) + y0.shape)
+
+def random_schedules(budgets, total_days, n, rng):
+    """Draw n schedules of one window per intervention within budget.
+
+    Returns: An integer array (n, interventions, 2) of start and end days.
+    """
+    schedules = np.empty((n, len(budgets), 2), dtype=int)
+    for k, budget in enumerate(budgets.values()):
+        length = rng.integers(0, min(budget, total_days) + 1, n)
+        start = rng.integers(0, total_days - length + 1)
+        schedules[:,k] = np.column_stack([start, start + length])
+    return schedules
+
+def mutate(schedules, budgets, total_days, n, rng, scale=14):
+    """Shift and stretch the windows of randomly chosen parent schedules.
+
+    Returns: An integer array (n, interventions, 2) of start and end days.
+    """
+    parents = schedules[rng.integers(0, len(schedules), n)]
+    limit = np.minimum(list(budgets.values()), total_days)
+    length = np.clip(np.diff(parents, axis=2)[...,0] + rng.integers(
+        -scale, scale + 1, parents.shape[:2]), 0, limit)
+    start = np.clip(parents[...,0] + rng.integers(
+        -scale, scale + 1, parents.shape[:2]), 0, total_days - length)
+    return np.stack([start, start + length], axis=2)
+
+def pareto_front(costs):
+    """Return a boolean mask of the rows of costs that no other row dominates.
+
+    Arguments:
+        costs: Array (candidates, objectives), all to be minimized
+    """
+    order = np.lexsort(costs.T[::-1])
+    front = np.zeros(len(costs), dtype=bool)
+    kept = []
+    for i in order:
+        if not any(np.all(costs[j] <= costs[i]) for j in kept):
+            front[i] = True
+            kept.append(i)
+    return front
+
+def evaluate(scenario, npis, schedules, prefix, chunk_size=64,
+             processes=None, **options):
+    """Deaths and peak infections for every schedule.
+
+    Arguments:
+        scenario: Dict with the fixed inputs, cf. uncertainty.make_scenario
+        npis: Names of the scheduled interventions
+        schedules: Integer array (n, interventions, 2) of windows
+        prefix: Baseline days and states, as returned by baseline()
+        chunk_size: Number of schedules solved together as one ensemble
+        processes: Number of worker processes; defaults to the CPU count
+        options: Keyword arguments for model.SEIREnsemble.solve
+
+    Returns: Arrays of deaths and peak infections, shape (n,). Schedules
+        pruned against scenario['capacity'] get infinite deaths.
+    """
+    t, states = prefix
+    infected = states[...,model.COMPARTMENTS.index('Infected')].sum(axis=1)
+    running_peak = np.maximum.accumulate(infected)
+    deaths, peaks = np.full(len(schedules), np.inf), np.empty(len(schedules))
+
+    # a schedule follows the baseline until its first window opens
+    first = np.where(np.diff(schedules, axis=2)[...,0] > 0,
+                     schedules[...,0], len(t) - 1).min(axis=1)
+    first = np.minimum(first, len(t) - 1)
+    peaks[:] = np.concatenate(([0], running_peak))[first]
+    feasible = peaks <= scenario.get('capacity', np.inf)
+
+    order = np.argsort(first)
+    order = order[feasible[order]]
+    chunks = []
+    for i in range(0, len(order), chunk_size):
+        idx = order[i:i+chunk_size]
+        t0 = first[idx[0]]
+        chunks.append((scenario, npis, schedules[idx], idx, t0, states[t0],
+                       options))
+    for idx, chunk_deaths, chunk_peaks in uncertainty.map_chunks(
+            _evaluate_chunk, chunks, processes):
+        deaths[idx] = chunk_deaths
+        peaks[idx] = np.maximum(peaks[idx], chunk_peaks)
+    deaths[peaks > scenario.get('capacity', np.inf)] = np.inf
+    return deaths, peaks
+
+def _evaluate_chunk(scenario, npis, schedules, idx, t0, y0, options):
+    day_ranges, selected_npis = [], []
+    for windows in schedules:
+        used = [k for k, (start, end) in enumerate(windows) if end > start]
+        day_ranges.append([windows[k] for k in used])
+        selected_npis.append([npis[k] for k in used])
+    ensemble = uncertainty.schedule_ensemble(scenario, day_ranges,
+                                             selected_npis)
+    options = dict({'piecewise': True}, **options)
+    _, y = ensemble.solve(y0, t_start=t0, **options)
+    y = y.sum(axis=2)
+    return (idx, y[:,-1,model.COMPARTMENTS.index('Dead')],
+            y[...,model.COMPARTMENTS.index('Infected')].max(axis=1))
+
+def optimize_schedule(budgets, total_days, region='Americas',
+                      initial_infected=.001, population=1e6, day_ranges=(),
+                      selected_npis=(), capacity=None, n_candidates=256,
+                      generations=8, chunk_size=64, processes=None,
+                      seed=None, **options):
+    """Search for schedules that trade deaths against intervention days.
+
+    Arguments:
+        budgets: Dict of {intervention: maximum days}, one window each, for
+            interventions in model.NPI_IMPACTS
+        total_days: Total number of days to run model
+        region, initial_infected, population: cf. uncertainty.uncertainty
+        day_ranges, selected_npis: Fixed interventions, as for
+            model.model_input, in place regardless of the schedule
+        capacity: Optional ceiling on the number infected on any day;
+            schedules above it are excluded from the front.
+        n_candidates: Number of schedules evaluated per generation
+        generations: Number of rounds of mutation after the initial draw
+        chunk_size: Number of schedules solved together as one ensemble
+        processes: Number of worker processes; defaults to the CPU count
+        seed: Seed for the search
+        options: Keyword arguments for model.SEIREnsemble.solve
+
+    Returns: A dataframe of the Pareto front, sorted by intervention days,
+        with start and end columns per intervention, deaths,
+        peak_infections and intervention_days.
+    """
+    npis = list(budgets)
+    unknown = set(npis) - set(model.NPI_IMPACTS)
+    if unknown:
+        raise ValueError('Unknown interventions: %s' % sorted(unknown))
+    scenario = uncertainty.make_scenario(day_ranges, selected_npis,
+                                         total_days, region, initial_infected,
+                                         population)
+    if capacity is not None:
+        scenario['capacity'] = capacity
+    prefix = baseline(scenario)
+    rng = np.random.default_rng(seed)
+
+    # evaluated schedules, keyed by their windows
+    results = {}
+    candidates = random_schedules(budgets, total_days, n_candidates, rng)
+    for generation in range(generations + 1):
+        # unused interventions all share the empty window (0, 0)
+        candidates[candidates[...,1] == candidates[...,0]] = 0
+        new = np.unique(candidates, axis=0)
+        new = new[[s.tobytes() not in results for s in new]]
+        if len(new):
+            deaths, peaks = evaluate(scenario, npis, new, prefix, chunk_size,
+                                     processes, **options)
+            for s, d, p in zip(new, deaths, peaks):
+                results[s.tobytes()] = (s, d, p)
+        schedules, deaths, peaks = _tabulate(results, len(npis))
+        days = np.diff(schedules, axis=2)[...,0].sum(axis=1)
+        front = pareto_front(np.column_stack([deaths, days]))
+        front &= np.isfinite(deaths)
+        if generation < generations:
+            # until a schedule meets the capacity, breed from the lowest peaks
+            parents = (schedules[front] if front.any() else
+                       schedules[np.argsort(peaks)[:max(len(peaks) // 8, 1)]])
+            candidates = mutate(parents, budgets, total_days, n_candidates,
+                                rng)
+
+    columns = {}
+    for k, npi in enumerate(npis):
+        columns[npi + ' start'] = schedules[front,k,0]
+        columns[npi + ' end'] = schedules[front,k,1]
+    columns.update(deaths=deaths[front], peak_infections=peaks[front],
+                   intervention_days=days[front])
+    return pd.DataFrame(columns).sort_values(
+        'intervention_days').reset_index(drop=True)
+
+def _tabulate(results, n_npis):
+    """Stack the evaluated schedules, deaths and peaks into arrays."""
+    if not results:
+        return np.empty((0, n_npis, 2), dtype=int), np.empty(0), np.empty(0)
+    schedules, deaths, peaks = zip(*results.values())
+    return np.array(schedules), np.array(deaths), np.array(peaks)
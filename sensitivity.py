@@ -0,0 +1,159 @@
+"""Variance-based global sensitivity analysis of the SEIR model.
+
+First-order and total Sobol indices are estimated with the Saltelli sampling
+scheme: two independent sample matrices A and B, plus one matrix per
+parameter with that parameter's column taken from B, so that N * (d + 2)
+model runs serve every index. The runs are solved in parallel batches with
+the machinery in uncertainty.py, and a bootstrap over the N base samples,
+together with the estimates on growing subsets, serves as a convergence
+diagnostic.
+
+Example:
+
+    indices = sensitivity.sobol_indices(
+        [(30, 70), (70, 200)], ['School closure', 'Quarantine and tracing'],
+        300, n_base=1024)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import model
+import uncertainty
+
+# The uncertainty ranges, plus an overall scale on the contact matrix
+PARAMETER_RANGES = dict(uncertainty.PARAMETER_RANGES, contact_scale=(.8, 1.2))
+
+def peak_infections(t, y):
+    """Largest number infected on any day."""
+    return y[:,:,model.COMPARTMENTS.index('Infected')].max(axis=1)
+
+def peak_day(t, y):
+    """Day on which the number infected peaks."""
+    return t[y[:,:,model.COMPARTMENTS.index('Infected')].argmax(axis=1)] * 1.
+
+def cumulative_deaths(t, y):
+    """Deaths by the end of the horizon."""
+    return y[:,-1,model.COMPARTMENTS.index('Dead')]
+
+# Scalar outputs, as functions of the days and of trajectories summed over
+# cohorts, shape (runs, days, compartments). Module-level functions, so that
+# they can be sent to worker processes.
+OUTPUTS = {
+    'peak_infections': peak_infections,
+    'peak_day': peak_day,
+    'cumulative_deaths': cumulative_deaths
+}
+
+def saltelli_samples(parameter_ranges, n_base, seed=None):
+    """Build the Saltelli design.
+
+    Returns: A dataframe of N * (d + 2) parameter rows, ordered as the blocks
+        A, B, AB_1, ..., AB_d, where AB_i is A with column i taken from B.
+    """
+    names = list(parameter_ranges)
+    base = uncertainty.sample_parameters(
+        {n: (0, 1) for n in names + ['_' + n for n in names]},
+        n_base, 'sobol', seed).values
+    a, b = base[:,:len(names)], base[:,len(names):]
+    blocks = [a, b]
+    for i in range(len(names)):
+        ab = a.copy()
+        ab[:,i] = b[:,i]
+        blocks.append(ab)
+    low, high = np.array([parameter_ranges[n] for n in names]).T
+    return pd.DataFrame(low + np.vstack(blocks) * (high - low), columns=names)
+
+def evaluate(scenario, samples, outputs=OUTPUTS, chunk_size=128,
+             processes=None, **options):
+    """Evaluate scalar outputs for every row of samples, in parallel batches.
+
+    Returns: A dataframe with one column per output, aligned with samples.
+    """
+    chunks = ((scenario, samples.iloc[i:i+chunk_size], i, outputs, options)
+              for i in range(0, len(samples), chunk_size))
+    results = np.empty((len(samples), len(outputs)))
+    for i, values in uncertainty.map_chunks(_evaluate_chunk, chunks,
+                                            processes):
+        results[i:i+len(values)] = values
+    return pd.DataFrame(results, columns=list(outputs))
+
+def _evaluate_chunk(scenario, samples, offset, outputs, options):
+    t, y = uncertainty.solve_samples(scenario, samples, **options)
+    return offset, np.column_stack([f(t, y) for f in outputs.values()])
+
+def _indices(f_a, f_b, f_ab):
+    """First-order (Saltelli 2010) and total (Jansen) index estimators.
+
+    Arguments:
+        f_a, f_b: Outputs for the A and B blocks, shape (N,)
+        f_ab: Outputs for the AB blocks, shape (d, N)
+
+    Returns: Arrays of first-order and total indices, shape (d,)
+    """
+    variance = np.var(np.concatenate([f_a, f_b]))
+    if variance == 0:
+        return np.zeros(len(f_ab)), np.zeros(len(f_ab))
+    first = np.mean(f_b * (f_ab - f_a), axis=1) / variance
+    total = 0.5 * np.mean((f_a - f_ab) ** 2, axis=1) / variance
+    return first, total
+
+def sobol_indices(day_ranges, selected_npis, total_days, region='Americas',
+                  initial_infected=.001, population=1e6,
+                  parameter_ranges=PARAMETER_RANGES, n_base=1024,
+                  outputs=OUTPUTS, n_bootstrap=200, confidence=95,
+                  chunk_size=128, processes=None, seed=None, **options):
+    """Estimate first-order and total Sobol indices of the model outputs.
+
+    Arguments:
+        day_ranges, selected_npis, total_days: Intervention schedule, as for
+            model.model_input
+        region, initial_infected, population: cf. uncertainty.uncertainty
+        parameter_ranges: Dict of uniform parameter ranges, cf.
+            PARAMETER_RANGES
+        n_base: Number of base samples N; a power of two. The model is
+            evaluated N * (d + 2) times for d parameters.
+        outputs: Dict of {name: function(t, y)} of scalar outputs, cf. OUTPUTS
+        n_bootstrap: Number of bootstrap resamples for confidence intervals
+        confidence: Confidence level of the bootstrap intervals, in percent
+        chunk_size: Number of model runs solved together as one ensemble
+        processes: Number of worker processes; defaults to the CPU count
+        seed: Seed for the sampler and the bootstrap
+        options: Keyword arguments for model.SEIREnsemble.solve
+
+    Returns: A tidy dataframe with one row per (output, parameter, index),
+        giving the estimate, its bootstrap confidence interval and, as a
+        convergence diagnostic, the estimates from the first quarter and half
+        of the base samples.
+    """
+    scenario = uncertainty.make_scenario(day_ranges, selected_npis,
+                                         total_days, region, initial_infected,
+                                         population)
+    names = list(parameter_ranges)
+    samples = saltelli_samples(parameter_ranges, n_base, seed)
+    values = evaluate(scenario, samples, outputs, chunk_size, processes,
+                      **options)
+
+    rng = np.random.default_rng(seed)
+    resamples = rng.integers(0, n_base, (n_bootstrap, n_base))
+    tail = (100 - confidence) / 2
+    rows = []
+    for output in outputs:
+        blocks = values[output].values.reshape(len(names) + 2, n_base)
+        f_a, f_b, f_ab = blocks[0], blocks[1], blocks[2:]
+        estimates = _indices(f_a, f_b, f_ab)
+        boot = np.array([_indices(f_a[r], f_b[r], f_ab[:,r])
+                         for r in resamples])
+        low, high = np.percentile(boot, [tail, 100 - tail], axis=0)
+        partial = [_indices(f_a[:n], f_b[:n], f_ab[:,:n])
+                   for n in (n_base // 4, n_base // 2)]
+        for k, index in enumerate(['first', 'total']):
+            for i, name in enumerate(names):
+                rows.append({
+                    'output': output, 'parameter': name, 'index': index,
+                    'estimate': estimates[k][i],
+                    'ci_low': low[k][i], 'ci_high': high[k][i],
+                    'estimate_quarter': partial[0][k][i],
+                    'estimate_half': partial[1][k][i]})
+    return pd.DataFrame(rows)
@@ -0,0 +1,172 @@
+"""Stochastic counterpart of the age-structured SEIR model, by tau-leaping.
+
+The deterministic model averages over chance; in small populations, and
+early in an outbreak, chance decides whether the epidemic takes off at all.
+Here every transition of model.SEIRModel is an integer count, drawn over a
+fixed leap tau as a binomial draw on the source compartment with the
+probability 1 - exp(-rate * tau), so compartments never go negative. The
+rates, contact matrices and epoch schedule are read off an SEIRModel.
+
+Realizations are simulated together as a (realization, cohort, compartment)
+integer array and sharded across a process pool, each shard with its own
+RNG stream spawned from one seed, so results do not depend on the number of
+processes. Shards are reduced as they arrive into running moments and
+uncertainty.StreamingPercentiles histograms, so memory does not grow with the
+number of realizations.
+
+Example:
+
+    contacts, epoch_end_times = model.model_input(
+        model.CONTACT_MATRICES_0['Europe'], [(30, 70)], ['School closure'],
+        300)
+    seir = model.SEIRModel(contacts, epoch_end_times)
+    y0 = uncertainty.initial_state('Europe', .001, population=1e4)
+    bands, extinction = stochastic.simulate(seir, y0, 10000, seed=0)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import model
+import uncertainty
+
+def tau_leap(seir, y0, n_realizations, tau=.25, rng=None):
+    """Simulate realizations of the model by tau-leaping.
+
+    Arguments:
+        seir: SEIRModel giving the rates, contacts and epoch schedule
+        y0: Initial state (cohorts, compartments); rounded to whole people
+        n_realizations: Number of realizations
+        tau: Leap in days; one day must be a whole number of leaps.
+        rng: numpy.random.Generator
+
+    Returns: The days and an integer array (realizations, days, cohorts,
+        compartments) of the state at the start of each day.
+    """
+    steps = int(round(1 / tau))
+    if not np.isclose(steps * tau, 1):
+        raise ValueError('One day must be a whole number of leaps.')
+    rng = np.random.default_rng() if rng is None else rng
+    t_eval = np.arange(seir.epoch_end_times[-1])
+
+    y = np.empty((n_realizations, len(t_eval), seir.N_cohorts,
+                  seir.N_compartments), dtype=np.int64)
+    state = np.broadcast_to(
+        np.rint(np.reshape(y0, (seir.N_cohorts, seir.N_compartments))),
+        (n_realizations, seir.N_cohorts, seir.N_compartments)).astype(
+            np.int64)
+    s, e, i, m, r, d = seir.s, seir.e, seir.i, seir.m, seir.r, seir.d
+    p_exposed = -np.expm1(-seir.alpha * tau)
+    p_recover = -np.expm1(-seir.gamma * tau)
+    p_die = -np.expm1(-seir.delta * tau)
+    size = state.sum(axis=2)
+    for k, day in enumerate(t_eval):
+        y[:,k] = state
+        for step in range(steps):
+            contact = seir.contact(day + (step + .5) * tau)
+            prevalence = (state[...,i] + state[...,m]) / np.maximum(size, 1)
+            force = seir.beta * prevalence @ np.transpose(contact)
+            infections = rng.binomial(state[...,s], -np.expm1(-force * tau))
+            onsets = rng.binomial(state[...,e], p_exposed)
+            severe = rng.binomial(onsets, seir.kappa)
+            recoveries = rng.binomial(state[...,i], p_recover)
+            deaths = rng.binomial(state[...,m], p_die)
+            state[...,s] -= infections
+            state[...,e] += infections - onsets
+            state[...,i] += onsets - severe - recoveries
+            state[...,m] += severe - deaths
+            state[...,r] += recoveries
+            state[...,d] += deaths
+    return t_eval, y
+
+class StreamingMoments(object):
+    """Running mean and variance, merged batch by batch (Chan et al.).
+
+    Attributes:
+        n: Number of trajectories seen
+        mean: Running mean
+        m2: Running sum of squared deviations from the mean
+
+    External methods:
+        add: Add a batch of trajectories.
+        std: The sample standard deviation.
+    """
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, trajectories):
+        """Add a batch of trajectories, stacked along the first axis."""
+        n = len(trajectories)
+        mean = trajectories.mean(axis=0)
+        m2 = ((trajectories - mean) ** 2).sum(axis=0)
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    def std(self):
+        """The sample standard deviation."""
+        return np.sqrt(self.m2 / max(self.n - 1, 1))
+
+def simulate(seir, y0, n_realizations, tau=.25,
+             percentiles=(5, 25, 50, 75, 95), chunk_size=256,
+             processes=None, seed=None):
+    """Summary statistics of many tau-leaping realizations.
+
+    Arguments:
+        seir: SEIRModel giving the rates, contacts and epoch schedule
+        y0: Initial state (cohorts, compartments), or flattened
+        n_realizations: Number of realizations
+        tau: Leap in days, cf. tau_leap
+        percentiles: Percentiles to report
+        chunk_size: Number of realizations simulated together per shard
+        processes: Number of worker processes; defaults to the CPU count
+        seed: Seed from which every shard's RNG stream is spawned
+
+    Returns: A tidy dataframe with columns days, Group, mean, std and one
+        column per percentile (e.g. p5), giving counts summed over cohorts;
+        and a series, indexed by day, of the fraction of realizations in
+        which the epidemic has died out (no one exposed or infected).
+    """
+    sizes = [min(chunk_size, n_realizations - i)
+             for i in range(0, n_realizations, chunk_size)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    # workers rebuild the model from its schedule and rates, so nothing
+    # else of it (e.g. an instrumented profile) has to be pickled
+    schedule = (list(seir.contacts), list(seir.epoch_end_times),
+                seir.parameters())
+    chunks = (schedule + (y0, n, tau, stream)
+              for n, stream in zip(sizes, streams))
+
+    moments, histograms, extinct = None, None, 0
+    for t, trajectories, chunk_extinct in uncertainty.map_chunks(
+            _simulate_chunk, chunks, processes):
+        if moments is None:
+            population = trajectories[0,0].sum()
+            moments = StreamingMoments(trajectories.shape[1:])
+            histograms = uncertainty.StreamingPercentiles(
+                trajectories.shape[1:], .5, max(population, 1))
+        moments.add(trajectories)
+        histograms.add(trajectories)
+        extinct = extinct + chunk_extinct
+
+    bands = histograms.percentiles(percentiles)
+    columns = {'mean': moments.mean, 'std': moments.std()}
+    columns.update({'p%g' % q: b for q, b in zip(percentiles, bands)})
+    df = pd.DataFrame(dict(
+        {'days': np.tile(t, len(model.COMPARTMENTS)),
+         'Group': np.repeat(model.COMPARTMENTS, len(t))},
+        **{k: v.T.ravel() for k, v in columns.items()}))
+    return df, pd.Series(extinct / n_realizations, index=t, name='extinct')
+
+def _simulate_chunk(contacts, epoch_end_times, parameters, y0, n, tau,
+                    stream):
+    seir = model.SEIRModel(contacts, epoch_end_times, **parameters)
+    t, y = tau_leap(seir, y0, n, tau, np.random.default_rng(stream))
+    y = y.sum(axis=2)
+    active = y[...,[seir.e, seir.i, seir.m]].sum(axis=2)
+    return t, y.astype(float), (active == 0).sum(axis=0)
@@ -0,0 +1,65 @@
+"""Checks of the yearly totals cube against pandas groupbys.
+
+Run with:
+
+    python -m pytest -q
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+
+def _fires(n=5000, seed=0):
+    # perimeters over 1900-2020 with some years and causes without records,
+    # and missing areas
+    rng = np.random.default_rng(seed)
+    years = rng.choice(np.setdiff1d(np.arange(1900, 2021), [1950, 1951]), n)
+    acres = rng.lognormal(3, 2, n)
+    acres[rng.random(n) < .05] = np.nan
+    return pd.DataFrame({'YEAR': years, 'GIS_ACRES': acres,
+                         'CAUSE': rng.choice([1, 2, 3, 5, 9, 14], n)})
+
+def test_series_matches_groupby():
+    fires = _fires()
+    cube = aggregates.YearlyCube(fires.YEAR, fires.GIS_ACRES,
+                                 cause=fires.CAUSE)
+    for cause in [aggregates.ALL, 1, 2, 3, 5, 9, 14]:
+        selected = (fires if cause == aggregates.ALL else
+                    fires[fires.CAUSE == cause])
+        expected = selected.groupby('YEAR').GIS_ACRES.sum()
+        series = pd.Series(cube.series(cause=cause), index=cube.years)
+        np.testing.assert_allclose(series[expected.index], expected,
+                                   rtol=1e-12)
+        # and zero on the years the groupby has no row for
+        assert not series.drop(expected.index).any()
+    # a cause without records
+    assert not cube.series(cause=4).any()
+
+def test_rolling_mean_counts_missing_years_as_zero():
+    fires = pd.DataFrame({'YEAR': [2000, 2000, 2002, 2004],
+                          'GIS_ACRES': [4., 6., 30., 8.]})
+    cube = aggregates.YearlyCube(fires.YEAR, fires.GIS_ACRES)
+    np.testing.assert_allclose(cube.rolling_mean(1),
+                               [10, 5, 15, 15, 4])
+
+    # the same as a trailing mean over every calendar year, not over the
+    # years with records (the chart's former window, which gave 20 for
+    # 2002)
+    yearly = fires.groupby('YEAR').GIS_ACRES.sum()
+    calendar = yearly.reindex(cube.years, fill_value=0)
+    for window in [1, 3, 15]:
+        np.testing.assert_allclose(
+            cube.rolling_mean(window),
+            calendar.rolling(window + 1, min_periods=1).mean())
+    assert yearly.rolling(2, min_periods=1).mean()[2002] == 20
+
+def test_frame_keeps_earlier_years_in_the_window():
+    fires = _fires()
+    cube = aggregates.YearlyCube(fires.YEAR, fires.GIS_ACRES,
+                                 cause=fires.CAUSE)
+    frame = cube.frame(15, start=1911, cause=2)
+    assert frame.year.iloc[0] == pd.Timestamp('1911-01-01')
+    np.testing.assert_allclose(frame.rolling_mean,
+                               cube.rolling_mean(15, cause=2)[11:])
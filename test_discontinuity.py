@@ -0,0 +1,76 @@
+"""Checks of the prefix-sum regressions against direct fits.
+
+Run with:
+
+    python -m pytest -q
+
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import discontinuity
+
+@pytest.fixture
+def daily():
+    # a noisy daily series with a jump at 1990, and days missing at random
+    # as in the NFDRS records
+    rng = np.random.default_rng(0)
+    dates = np.arange('1980-01-01', '2000-01-01', dtype='datetime64[D]')
+    dates = dates[np.r_[True, rng.random(len(dates) - 2) > .1, True]]
+    years = (dates - dates[0]).astype(float) / discontinuity.DAYS_PER_YEAR
+    y = 50 + 0.5 * years + 8 * (dates >= np.datetime64('1990-01-01'))
+    return dates, y + rng.normal(0, 5, len(dates))
+
+def test_fit_matches_polyfit(daily):
+    dates, y = daily
+    engine = discontinuity.BreakRegression(dates, y)
+    for start, end in [(None, None), ('1980-01-01', '1990-01-01'),
+                       ('1985-06-15', '1999-03-01')]:
+        fit = engine.fit(None if start is None else np.datetime64(start),
+                         None if end is None else np.datetime64(end))
+        inside = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            inside &= (dates >= np.datetime64(start)) & (
+                dates < np.datetime64(end))
+        slope, intercept = np.polyfit(engine.t[inside], engine.y[inside], 1)
+        assert fit['n'] == inside.sum()
+        np.testing.assert_allclose([fit['slope'], fit['intercept']],
+                                   [slope, intercept], rtol=1e-9)
+
+def test_break_matches_polyfit(daily):
+    dates, y = daily
+    engine = discontinuity.BreakRegression(dates, y)
+    breaks = np.array(['1985-01-01', '1990-01-01', '1995-07-01'],
+                      dtype='datetime64[s]')
+    tests = engine.test(breaks)
+    for row, t_break in zip(tests.itertuples(), engine._position(breaks)):
+        left, right = engine.t < t_break, engine.t >= t_break
+        line_left = np.polyfit(engine.t[left], engine.y[left], 1)
+        line_right = np.polyfit(engine.t[right], engine.y[right], 1)
+        np.testing.assert_allclose(
+            [row.slope_left, row.slope_right, row.value_left,
+             row.value_right],
+            [line_left[0], line_right[0], np.polyval(line_left, t_break),
+             np.polyval(line_right, t_break)], rtol=1e-9)
+    assert tests.jump_p[1] < 1e-6
+
+@pytest.mark.parametrize('seed', range(10))
+def test_segments_end_on_dates(seed):
+    # the round trip through years from the mean date must give back whole
+    # seconds, e.g. the first date, not a second before it
+    rng = np.random.default_rng(seed)
+    dates = np.arange('1980-01-01', '2020-05-19', dtype='datetime64[D]')
+    dates = dates[np.r_[True, rng.random(len(dates) - 2) > .1, True]]
+    engine = discontinuity.BreakRegression(dates, rng.random(len(dates)))
+    segments = engine.segments(np.datetime64('1990-01-01'))
+    assert list(segments.t) == list(pd.to_datetime(
+        ['1980-01-01', '1990-01-01', '1990-01-01', '2020-05-18']))
+
+def test_short_side_has_no_line(daily):
+    dates, y = daily
+    engine = discontinuity.BreakRegression(dates, y)
+    row = engine.test([dates[2]]).iloc[0]
+    assert row.n_left == 2 and np.isnan(row.jump)
+    assert set(engine.segments(dates[2]).side) == {'right'}
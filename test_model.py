@@ -0,0 +1,276 @@
+"""Accuracy checks of the model's solvers, schedules and gradients.
+
+Run with:
+
+    python -m pytest -q
+
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+import calibration
+import model
+import uncertainty
+
+# Parameter regimes of the RK4 check: the default rates, and rates fast
+# enough that an explicit step must be short to stay stable
+REGIMES = {
+    'default': {},
+    'stiff': {'incubation_period': 0.05, 'time_to_death': 0.1}
+}
+
+def _app_schedule(region, total_days=300):
+    """Contact matrices and epoch end times of a schedule like app.py's."""
+    return model.model_input(
+        model.CONTACT_MATRICES_0[region],
+        [(30, 70), (30, 80), (30, 100), (70, 200), (20, 20)],
+        ['School closure', 'Cancel mass gatherings', 'Shielding the elderly',
+         'Quarantine and tracing', 'Shelter in place'], total_days)
+
+@pytest.mark.parametrize('regime', sorted(REGIMES))
+@pytest.mark.parametrize('region', sorted(model.WORLD_POP))
+def test_rk4_error_bound(regime, region, population=1e6, bound=1e-4):
+    # RK4 at the default step rate stays within bound times the population
+    # of a piecewise DOP853 reference, on every day and in every compartment
+    contacts, epoch_end_times = _app_schedule(region)
+    y0 = uncertainty.initial_state(region, population=population).ravel()
+    seir = model.SEIRModel(contacts, epoch_end_times, **REGIMES[regime])
+    _, reference = seir.solve(
+        y0, piecewise=True, method='DOP853', rtol=1e-11, atol=1e-8)
+    _, y = seir.solve(y0, method='RK4')
+    assert np.abs(y - reference).max() <= bound * population
+
+def _model_input_by_sets(contact_matrix, day_ranges, selected_npis,
+                         total_days, npi_impacts=model.NPI_IMPACTS):
+    # model_input as it was before the interval arithmetic: an intervention
+    # applies to an epoch if their days overlap by more than one day
+    epochs = model._partition(day_ranges, total_days)
+    contacts = []
+    for start, end in epochs:
+        c_eff = np.array(contact_matrix, dtype=float)
+        for day_range, npi in zip(day_ranges, selected_npis):
+            if len(set(range(*day_range)) & set(range(start, end))) > 1:
+                impact = npi_impacts.get(npi, {})
+                c_eff *= impact.get('chi', 1)
+                for idx_pair in impact.get('indices', []):
+                    c_eff[idx_pair] *= impact.get('xi', 1)
+        contacts.append(c_eff)
+    return contacts, [end for _, end in epochs]
+
+@pytest.mark.parametrize('seed', range(20))
+def test_model_input_matches_sets(seed, total_days=200):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(1, 12)
+    starts = rng.integers(0, total_days, n)
+    day_ranges = [(int(s), int(s + rng.integers(0, 60))) for s in starts]
+    selected_npis = list(rng.choice(
+        sorted(model.NPI_IMPACTS) + ['No impact'], n))
+    contact_matrix = model.CONTACT_MATRICES_0['Europe']
+
+    expected, expected_ends = _model_input_by_sets(
+        contact_matrix, day_ranges, selected_npis, total_days)
+    contacts, ends = model.model_input(
+        contact_matrix, day_ranges, selected_npis, total_days, merge=False)
+    assert ends == expected_ends
+    np.testing.assert_allclose(contacts, expected, rtol=1e-13)
+
+    # merging equal neighbours keeps the contact matrix of every day
+    merged, merged_ends = model.model_input(
+        contact_matrix, day_ranges, selected_npis, total_days)
+    for day in range(total_days):
+        k = np.searchsorted(expected_ends, day, 'right')
+        m = np.searchsorted(merged_ends, day, 'right')
+        np.testing.assert_allclose(merged[m], expected[k], rtol=1e-13)
+
+@pytest.mark.parametrize('shielding_chi', [None, .8])
+def test_calibration_gradient(monkeypatch, shielding_chi, days=120):
+    if shielding_chi is not None:
+        # an impact with both indices and an overall chi
+        monkeypatch.setitem(
+            model.NPI_IMPACTS, 'Shielding the elderly',
+            dict(model.NPI_IMPACTS['Shielding the elderly'],
+                 chi=shielding_chi))
+    fit_npis = ['Shelter in place', 'School closure', 'Shielding the elderly']
+    problem = calibration.Calibration(
+        np.zeros(days), np.zeros(days), [(20, 60), (30, 90), (40, 100)],
+        fit_npis, region='Europe', population=1e7, fit_npis=fit_npis)
+
+    # observations drawn from the model at other parameter values, which
+    # are those of a plain solve of the same schedule
+    truth = np.array([.04, .001, .4, .3, .6])
+    _, y, _ = problem.solve(truth)
+    impacts = {npi: dict(model.NPI_IMPACTS[npi]) for npi in fit_npis}
+    for npi, value in zip(fit_npis, truth[2:]):
+        impacts[npi]['xi' if 'indices' in impacts[npi] else 'chi'] = value
+    contacts, epoch_end_times = model.model_input(
+        model.CONTACT_MATRICES_0['Europe'], problem.day_ranges, fit_npis,
+        days + 1, impacts)
+    _, plain = model.SEIRModel(
+        contacts, epoch_end_times, prob_of_transmission=truth[0]).solve(
+        uncertainty.initial_state('Europe', truth[1], 1e7).ravel(),
+        piecewise=True, rtol=1e-6)
+    np.testing.assert_allclose(y, plain, rtol=1e-3, atol=1e-3)
+
+    ncomp = len(model.COMPARTMENTS)
+    rng = np.random.default_rng(0)
+    problem.cases = rng.poisson(np.diff(
+        y.reshape(-1, ncomp, days + 1)[:,2:].sum(axis=(0, 1)))).astype(float)
+    problem.deaths = rng.poisson(np.diff(
+        y.reshape(-1, ncomp, days + 1)[:,-1].sum(axis=0))).astype(float)
+
+    x = problem.to_search(np.array([.035, .002, .5, .2, .5]))
+    _, gradient = problem.nll(x)
+    central = np.empty(len(x))
+    for k in range(len(x)):
+        step = np.zeros(len(x))
+        step[k] = 1e-5
+        central[k] = (problem.nll(x + step)[0] -
+                      problem.nll(x - step)[0]) / 2e-5
+    np.testing.assert_allclose(gradient, central, rtol=1e-4,
+                               atol=1e-5 * np.abs(central).max())
+
+@pytest.mark.parametrize('region', sorted(model.WORLD_POP))
+def test_sparse_jacobian(region, days=120):
+    # the CSC Jacobian, built from its block structure, equals the dense one
+    # and stores only the linear part and the Susceptible and Exposed rows
+    contacts, epoch_end_times = _app_schedule(region, days)
+    seir = model.SEIRModel(contacts, epoch_end_times)
+    _, y = seir.solve(uncertainty.initial_state(region).ravel(),
+                      method='RK4')
+    for t in [0, 25, 50, 100]:
+        sparse = seir.jac(t, y[:,t], sparse=True)
+        assert sparse.format == 'csc'
+        np.testing.assert_array_equal(sparse.toarray(), seir.jac(t, y[:,t]))
+        n_coupled = 2 * seir.N_cohorts * len(y)
+        assert sparse.nnz <= n_coupled + 6 * seir.N_cohorts
+
+def _solution(value, days=5):
+    return np.arange(days), np.full((6, days), float(value))
+
+def test_solution_cache_evicts_least_recently_used():
+    cache = model.SolutionCache(maxsize=2)
+    cache.put('a', *_solution(1))
+    cache.put('b', *_solution(2))
+    assert cache.get('a') is not None
+    cache.put('c', *_solution(3))
+    assert cache.get('b') is None
+    assert cache.get('a')[1][0,0] == 1 and cache.get('c')[1][0,0] == 3
+    assert cache.stats()['size'] == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_solution_cache_read_only():
+    cache = model.SolutionCache()
+    t, y = _solution(1)
+    for array in cache.put('a', t, y) + cache.get('a'):
+        assert not array.flags.writeable
+    # the caller's arrays are copied, not frozen
+    y[0,0] = 2
+    assert cache.get('a')[1][0,0] == 1
+
+def test_solution_cache_disk_round_trip(tmp_path):
+    model.SolutionCache(directory=str(tmp_path)).put('a', *_solution(1))
+    assert [p.name for p in tmp_path.iterdir()] == ['a.npz']
+    cache = model.SolutionCache(directory=str(tmp_path))
+    t, y = cache.get('a')
+    np.testing.assert_array_equal(y, _solution(1)[1])
+    assert cache.get('a') is not None
+    assert (cache.disk_hits, cache.hits, cache.misses) == (1, 1, 0)
+
+def test_solution_cache_concurrent_puts(tmp_path):
+    # sessions are threads of one process; storing one key at once must
+    # neither fail nor publish a partial file
+    cache = model.SolutionCache(directory=str(tmp_path))
+    t, y = np.arange(20000), np.random.default_rng(0).random((54, 20000))
+    barrier = threading.Barrier(8)
+    errors = []
+    def put():
+        barrier.wait()
+        try:
+            cache.put('a', t, y)
+        except OSError as error:
+            errors.append(error)
+    threads = [threading.Thread(target=put) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert [p.name for p in tmp_path.iterdir()] == ['a.npz']
+    np.testing.assert_array_equal(
+        model.SolutionCache(directory=str(tmp_path)).get('a')[1], y)
+
+def test_solution_cache_key():
+    contacts, epoch_end_times = _app_schedule('Europe', 60)
+    seir = model.SEIRModel(contacts, epoch_end_times)
+    y0 = uncertainty.initial_state('Europe').ravel()
+    key = model.SolutionCache.key
+    assert key(seir, y0, piecewise=False) == key(seir, y0, piecewise=False)
+    keys = {key(seir, y0, piecewise=False),
+            key(seir, y0, piecewise=True),
+            key(seir, y0, piecewise=False, method='RK4'),
+            key(seir, y0 * 2, piecewise=False),
+            key(model.SEIRModel(contacts, epoch_end_times,
+                                prob_of_transmission=.05),
+                y0, piecewise=False)}
+    assert len(keys) == 5
+
+    # a solve through the cache stores under its options, and a repeat is
+    # served from memory
+    cache = model.SolutionCache()
+    _, y = seir.solve(y0, method='RK4', cache=cache)
+    _, again = seir.solve(y0, method='RK4', cache=cache)
+    assert again is y and cache.stats()['hits'] == 1
+    seir.solve(y0, cache=cache)
+    assert cache.stats()['misses'] == 2
+
+def _quarantine_schedule(school=(30, 70), quarantine=(70, 200)):
+    return model.model_input(
+        model.CONTACT_MATRICES_0['Americas'],
+        [school, (30, 80), (30, 100), quarantine, (20, 20)],
+        ['School closure', 'Cancel mass gatherings', 'Shielding the elderly',
+         'Quarantine and tracing', 'Shelter in place'], 300)
+
+# Changes to the schedule of _quarantine_schedule, whose epochs end on days
+# 30, 70, 80, 100, 200 and 300, and the checkpoint a re-solve restarts from
+RESCHEDULES = [
+    ({'quarantine': (70, 210)}, 200),
+    ({'quarantine': (70, 150)}, 100),
+    ({'quarantine': (70, 299)}, 200),
+    ({'quarantine': (70, 300)}, 200),
+    ({'school': (10, 70)}, 0),
+    ({}, 300)
+]
+
+@pytest.mark.parametrize('method', ['RK4', 'RK45'])
+@pytest.mark.parametrize('change, restart_time', RESCHEDULES)
+def test_reschedule_matches_fresh_solve(change, restart_time, method):
+    y0 = uncertainty.initial_state('Americas').ravel()
+    seir = model.SEIRModel(*_quarantine_schedule())
+    seir.solve(y0, piecewise=True, method=method)
+    seir.reschedule(*_quarantine_schedule(**change))
+    _, y = seir.solve(y0, piecewise=True, method=method)
+    assert seir.restart_time == restart_time
+    _, fresh = model.SEIRModel(*_quarantine_schedule(**change)).solve(
+        y0, piecewise=True, method=method)
+    if method == 'RK4':
+        np.testing.assert_array_equal(y, fresh)
+    else:
+        # a fresh model may merge epochs the checkpoints split, e.g. days
+        # 100-300 when quarantine runs to the end, so the adaptive steps
+        # differ within the solver's tolerance
+        np.testing.assert_allclose(y, fresh, rtol=1e-2, atol=1e-3 * y0.sum())
+
+def test_reschedule_restarts_from_zero_on_other_inputs():
+    y0 = uncertainty.initial_state('Americas').ravel()
+    seir = model.SEIRModel(*_quarantine_schedule())
+    seir.solve(y0, method='RK4')
+    seir.reschedule(*_quarantine_schedule(quarantine=(70, 210)))
+    # another initial state, and other options, share no checkpoints
+    seir.solve(y0 * 2, method='RK4')
+    assert seir.restart_time == 0
+    seir.reschedule(*_quarantine_schedule())
+    seir.solve(y0 * 2, method='RK4', step_rate=.25)
+    assert seir.restart_time == 0
@@ -0,0 +1,42 @@
+"""Checks of the tau-leaping simulator.
+
+Run with:
+
+    python -m pytest -q
+
+"""
+
+import numpy as np
+
+import model
+import stochastic
+import uncertainty
+
+def _model():
+    contacts, epoch_end_times = model.model_input(
+        model.CONTACT_MATRICES_0['Europe'], [(10, 30)], ['School closure'],
+        40)
+    return model.SEIRModel(contacts, epoch_end_times)
+
+def test_tau_leap_conserves_people():
+    seir = _model()
+    y0 = uncertainty.initial_state('Europe', .01, population=1e4)
+    t, y = stochastic.tau_leap(seir, y0, 16, rng=np.random.default_rng(0))
+    assert y.shape == (16, len(t), seir.N_cohorts, seir.N_compartments)
+    assert (y >= 0).all()
+    assert (y.sum(axis=3) == np.rint(y0).sum(axis=1)).all()
+
+def test_simulate_instrumented_model_across_processes():
+    # workers get the schedule and rates, not the instrumented model, and
+    # the result does not depend on the number of processes
+    seir = _model()
+    seir.instrument()
+    y0 = uncertainty.initial_state('Europe', .01, population=1e4)
+    results = [stochastic.simulate(seir, y0, 64, chunk_size=16,
+                                   processes=processes, seed=0)
+               for processes in [1, 2]]
+    for (bands, extinct), (other_bands, other_extinct) in zip(
+            results, results[1:]):
+        np.testing.assert_allclose(bands['mean'], other_bands['mean'],
+                                   rtol=1e-12)
+        np.testing.assert_array_equal(extinct, other_extinct)
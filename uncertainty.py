@@ -0,0 +1,322 @@
+"""Monte Carlo uncertainty bands for the age-structured SEIR model.
+
+Uncertain parameters are drawn by Latin hypercube or Sobol sampling and
+solved in chunks, each chunk as one model.SEIREnsemble integration, across a
+process pool. Trajectories are reduced as they arrive into per-day histograms
+for each compartment, from which percentile bands are read off, so memory
+does not grow with the number of samples.
+
+Example:
+
+    bands = uncertainty.uncertainty(
+        [(30, 70), (70, 200)], ['School closure', 'Quarantine and tracing'],
+        300, n_samples=4096)
+
+"""
+
+import collections
+import concurrent.futures
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.stats.qmc
+
+import model
+
+# Uniform ranges for the uncertain parameters. Keys are SEIRModel keyword
+# arguments, 'fatality_scale' (a factor on model.INFECTION_FATALITY),
+# 'contact_scale' (a factor on the basic contact matrix) or the name of an
+# intervention in model.NPI_IMPACTS, whose chi (or xi, for cohort-based
+# interventions) is drawn from the range.
+PARAMETER_RANGES = {
+    'prob_of_transmission': (.025, .045),
+    'incubation_period': (4.1, 7.0),
+    'fatality_scale': (.5, 2.),
+    'Cancel mass gatherings': (.6, .85),
+    'Quarantine': (.5, .75),
+    'Quarantine and tracing': (.35, .6),
+    'School closure': (0, .3),
+    'Shelter in place': (.2, .5),
+    'Shielding the elderly': (.3, .7)
+}
+
+def sample_parameters(parameter_ranges, n_samples, sampler='lhs', seed=None):
+    """Draw a space-filling sample of the parameter ranges.
+
+    Arguments:
+        parameter_ranges: Dict of {name: (low, high)}, cf. PARAMETER_RANGES
+        n_samples: Number of samples; a power of two suits Sobol sampling.
+        sampler: 'lhs' (Latin hypercube) or 'sobol' (scrambled Sobol)
+        seed: Seed for the sampler
+
+    Returns: A dataframe with one column per parameter.
+    """
+    names = list(parameter_ranges)
+    if sampler == 'lhs':
+        engine = scipy.stats.qmc.LatinHypercube(len(names), seed=seed)
+    elif sampler == 'sobol':
+        engine = scipy.stats.qmc.Sobol(len(names), seed=seed)
+    else:
+        raise ValueError('Unknown sampler: %s' % sampler)
+    low, high = np.array([parameter_ranges[n] for n in names]).T
+    samples = scipy.stats.qmc.scale(engine.random(n_samples), low, high)
+    return pd.DataFrame(samples, columns=names)
+
+def make_scenario(day_ranges, selected_npis, total_days, region='Americas',
+                  initial_infected=.001, population=1e6):
+    """The dict of fixed inputs that ensembles are built from and that
+    worker processes receive.
+
+    Arguments:
+        day_ranges, selected_npis, total_days: Fixed intervention schedule,
+            as for model.model_input
+        region: Region in model.WORLD_POP
+        initial_infected: Initial fraction each of exposed and infected
+        population: Total population
+    """
+    return {'day_ranges': [tuple(r) for r in day_ranges],
+            'selected_npis': list(selected_npis), 'total_days': total_days,
+            'region': region, 'initial_infected': initial_infected,
+            'population': population}
+
+def schedule_ensemble(scenario, day_ranges=None, selected_npis=None,
+                      samples=None):
+    """Build a model.SEIREnsemble with one member per schedule or sample.
+
+    Each member follows the scenario's fixed interventions plus its own
+    windows, with its own parameter values.
+
+    Arguments:
+        scenario: Dict with the fixed inputs, cf. make_scenario
+        day_ranges: Per member, a list of further (start, end) windows;
+            None if the members add none
+        selected_npis: Per member, the interventions of those windows
+        samples: Dataframe (or list of dicts) of parameter values per
+            member, keyed as in PARAMETER_RANGES; None for the defaults
+
+    Returns: The ensemble.
+    """
+    rows = (samples.to_dict('records') if isinstance(samples, pd.DataFrame)
+            else samples)
+    n = len(day_ranges) if rows is None else len(rows)
+    rows = [{}] * n if rows is None else rows
+    day_ranges = [()] * n if day_ranges is None else day_ranges
+    selected_npis = [()] * n if selected_npis is None else selected_npis
+    contact_matrix = model.CONTACT_MATRICES_0[scenario['region']]
+    contacts, epoch_end_times, kwargs = [], [], {}
+    for row, ranges, npis in zip(rows, day_ranges, selected_npis):
+        npi_impacts = model.NPI_IMPACTS
+        if any(npi in row for npi in npi_impacts):
+            npi_impacts = copy.deepcopy(npi_impacts)
+            for npi, impact in npi_impacts.items():
+                if npi in row:
+                    impact['xi' if 'indices' in impact else 'chi'] = row[npi]
+        c, ends = model.model_input(
+            contact_matrix * row.get('contact_scale', 1),
+            list(scenario['day_ranges']) + [tuple(r) for r in ranges],
+            list(scenario['selected_npis']) + list(npis),
+            scenario['total_days'], npi_impacts)
+        contacts.append(c)
+        epoch_end_times.append(ends)
+
+    for name in ['incubation_period', 'prob_of_transmission',
+                 'duration_of_infection', 'time_to_death']:
+        if name in rows[0]:
+            kwargs[name] = [row[name] for row in rows]
+    if 'fatality_scale' in rows[0]:
+        kwargs['mortality_rates'] = np.outer(
+            [row['fatality_scale'] for row in rows], model.INFECTION_FATALITY)
+    return model.SEIREnsemble(contacts, epoch_end_times, **kwargs)
+
+def initial_state(region, initial_infected=.001, population=1e6):
+    """Initial state as in app.py: a fraction exposed and infected."""
+    f = population * model.WORLD_POP[region]
+    i = initial_infected
+    return np.array([[p * (1 - 2 * i), p * i, p * i, 0, 0, 0] for p in f])
+
+def solve_samples(scenario, samples, **options):
+    """Solve one chunk of samples as a single ensemble.
+
+    Returns: The days and an array (samples, days, compartments) of the
+        trajectories summed over cohorts.
+    """
+    ensemble = schedule_ensemble(scenario, samples=samples)
+    y0 = initial_state(scenario['region'],
+                       scenario.get('initial_infected', .001),
+                       scenario.get('population', 1e6))
+    options.setdefault('piecewise', True)
+    t, y = ensemble.solve(y0, **options)
+    return t, y.sum(axis=2)
+
+def map_chunks(fn, chunks, processes=None):
+    """Apply fn to each chunk, in a process pool, yielding results as done.
+
+    At most twice as many chunks as workers are in flight at once, so that
+    neither inputs nor results pile up. With processes=1, chunks are
+    evaluated in this process. Otherwise fn and the chunks are pickled to
+    the workers, so fn must be a module-level function.
+    """
+    processes = processes or os.cpu_count()
+    if processes == 1:
+        for chunk in chunks:
+            yield fn(*chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        pending = set()
+        for chunk in chunks:
+            pending.add(executor.submit(fn, *chunk))
+            if len(pending) >= 2 * processes:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+def map_ordered(fn, chunks, processes=None):
+    """Apply fn to each chunk in a process pool, yielding results in order.
+
+    As in map_chunks, at most twice as many chunks as workers are in
+    flight; a slow chunk holds back the results behind it rather than
+    letting them pile up. With processes=1, chunks are evaluated in this
+    process; otherwise fn must be module-level, as in map_chunks.
+    """
+    processes = processes or os.cpu_count()
+    if processes == 1:
+        for chunk in chunks:
+            yield fn(*chunk)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(fn, *chunk))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class StreamingPercentiles(object):
+    """Running per-day histograms from which percentiles can be read off.
+
+    Values are binned on a logarithmic grid from lowest to highest, so the
+    percentiles are resolved to a fixed relative precision. Running sums,
+    minima and maxima give the exact mean and keep interpolated percentiles
+    within the range of the values seen.
+
+    Attributes:
+        edges: Bin edges, with a first bin for values below lowest
+        counts: Integer array (days, series, bins) of counts
+        total: Sum of the values seen, per day and series
+        low, high: Smallest and largest values seen, per day and series
+        n: Number of trajectories seen
+
+    External methods:
+        add: Add a batch of trajectories.
+        percentiles: Read percentiles off the histograms.
+        mean: The mean trajectory.
+    """
+    def __init__(self, shape, lowest, highest, bins=2048):
+        self.edges = np.concatenate(
+            ([0], np.geomspace(lowest, highest, bins - 1)))
+        self.counts = np.zeros(tuple(shape) + (bins,), dtype=np.int64)
+        self.total = np.zeros(shape)
+        self.low = np.full(shape, np.inf)
+        self.high = np.full(shape, -np.inf)
+        self.n = 0
+
+    def add(self, trajectories):
+        """Add a batch of trajectories of shape (batch, days, series)."""
+        bins = self.counts.shape[-1]
+        idx = np.clip(np.searchsorted(self.edges, trajectories, 'right') - 1,
+                      0, bins - 1)
+        offsets = np.arange(np.prod(self.counts.shape[:-1])).reshape(
+            self.counts.shape[:-1]) * bins
+        self.counts += np.bincount(
+            (idx + offsets).ravel(),
+            minlength=self.counts.size).reshape(self.counts.shape)
+        self.total += trajectories.sum(axis=0)
+        np.minimum(self.low, trajectories.min(axis=0), out=self.low)
+        np.maximum(self.high, trajectories.max(axis=0), out=self.high)
+        self.n += len(trajectories)
+
+    def percentiles(self, q):
+        """Percentiles q (0-100), interpolated within bins.
+
+        Returns: Array (len(q), days, series)
+        """
+        cumulative = self.counts.cumsum(axis=-1)
+        upper = np.append(self.edges[1:], self.edges[-1])
+        bands = []
+        for rank in np.asarray(q) / 100 * self.n:
+            k = np.minimum(
+                (cumulative < rank).sum(axis=-1), self.counts.shape[-1] - 1)
+            below = np.take_along_axis(
+                cumulative, k[...,None], -1)[...,0] - np.take_along_axis(
+                self.counts, k[...,None], -1)[...,0]
+            inside = np.maximum(
+                np.take_along_axis(self.counts, k[...,None], -1)[...,0], 1)
+            frac = np.clip((rank - below) / inside, 0, 1)
+            bands.append(np.clip(
+                self.edges[k] + frac * (upper[k] - self.edges[k]),
+                self.low, self.high))
+        return np.array(bands)
+
+    def mean(self):
+        """The mean trajectory, shape (days, series)."""
+        return self.total / max(self.n, 1)
+
+def uncertainty(day_ranges, selected_npis, total_days, region='Americas',
+                initial_infected=.001, population=1e6,
+                parameter_ranges=PARAMETER_RANGES, n_samples=1024,
+                sampler='lhs', percentiles=(5, 25, 50, 75, 95),
+                chunk_size=64, processes=None, seed=None, **options):
+    """Percentile bands of the model trajectories under parameter uncertainty.
+
+    Arguments:
+        day_ranges, selected_npis, total_days: Intervention schedule, as for
+            model.model_input
+        region: Region in model.WORLD_POP
+        initial_infected: Initial fraction each of exposed and infected
+        population: Total population
+        parameter_ranges: Dict of uncertain parameter ranges, cf.
+            PARAMETER_RANGES
+        n_samples: Number of parameter samples
+        sampler: 'lhs' or 'sobol'
+        percentiles: Percentiles to report
+        chunk_size: Number of samples solved together as one ensemble
+        processes: Number of worker processes; defaults to the CPU count
+        seed: Seed for the sampler
+        options: Keyword arguments for model.SEIREnsemble.solve
+
+    Returns: A tidy dataframe with columns days, Group, mean and one column
+        per percentile (e.g. p5), giving population counts summed over
+        cohorts.
+    """
+    scenario = make_scenario(day_ranges, selected_npis, total_days, region,
+                             initial_infected, population)
+    samples = sample_parameters(parameter_ranges, n_samples, sampler, seed)
+    chunks = ((scenario, samples.iloc[i:i+chunk_size])
+              for i in range(0, n_samples, chunk_size))
+
+    stream = None
+    for t, trajectories in map_chunks(
+            _solve_chunk, ((s, c, options) for s, c in chunks), processes):
+        if stream is None:
+            stream = StreamingPercentiles(
+                trajectories.shape[1:], population * 1e-9, population)
+        stream.add(trajectories)
+
+    bands = stream.percentiles(percentiles)
+    columns = {'mean': stream.mean()}
+    columns.update({'p%g' % q: b for q, b in zip(percentiles, bands)})
+    return pd.DataFrame(dict(
+        {'days': np.tile(t, len(model.COMPARTMENTS)),
+         'Group': np.repeat(model.COMPARTMENTS, len(t))},
+        **{k: v.T.ravel() for k, v in columns.items()}))
+
+def _solve_chunk(scenario, samples, options):
+    return solve_samples(scenario, samples, **options)